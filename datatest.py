@@ -82,7 +82,7 @@ def process_file(file_path):
 
     try:
         result = subprocess.run(
-            ['python', '-m', 'remarks', file_path, "tests/out/data-out"],
+            ['python', '-m', 'remarks', file_path, "tests/out/data-out", "--page_timeout", "60"],
             capture_output=True, 
             check=True, 
             text=True,
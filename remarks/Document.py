@@ -1,10 +1,10 @@
 import math
-from typing import List
+from typing import Dict, List
 
 import fitz
 
 from remarks.conversion import check_rm_file_version
-from remarks.conversion.parsing import determine_document_dimensions
+from remarks.conversion.parsing import ParsedPage, parse_page
 from remarks.dimensions import REMARKABLE_DOCUMENT, ReMarkableDimensions
 from remarks.utils import (
     get_document_filetype,
@@ -29,16 +29,38 @@ class Document:
         self.rm_annotation_files = list_ann_rm_files(metadata_path)
         self.rm_highlight_files = list_hl_json_files(metadata_path)
 
-    def open_source_pdf(self) -> fitz.Document:
+        # Every .rm file is parsed at most once, then shared between the page sizing and the page rendering, which
+        # takes it out again
+        self._parsed_pages: Dict[str, ParsedPage] = {}
+
+    def parsed_page(self, page_uuid: str) -> ParsedPage:
+        if page_uuid not in self._parsed_pages:
+            path = next(f for f in self.rm_annotation_files if f.stem == page_uuid)
+            self._parsed_pages[page_uuid] = parse_page(path)
+        return self._parsed_pages[page_uuid]
+
+    def take_parsed_page(self, page_uuid: str) -> ParsedPage:
+        """Like `parsed_page`, for its last use: the page is not kept any longer"""
+        parsed_page = self.parsed_page(page_uuid)
+        del self._parsed_pages[page_uuid]
+        return parsed_page
+
+    def open_source_pdf(self, parse_pages: bool = True) -> fitz.Document:
+        """The document the annotations go on, as a new PDF for notebooks.
+
+        Notebook pages are as large as their annotations, which takes parsing them. Without `parse_pages` they
+        are all the size of the screen instead, for when the pages are parsed and rendered elsewhere (on watchdog
+        workers, within their budgets): the rendered page takes the place of the empty one, whatever its size."""
         if self.doc_type in ["pdf", "epub"]:
             f = self.metadata_path.with_name(f"{self.metadata_path.stem}.pdf")
             pdf_src = fitz.open(f)
 
+            inserted_page_dims = REMARKABLE_DOCUMENT.to_mm().to_mu()
             for i, page_idx in enumerate(self.pages_map):
                 if is_inserted_page(page_idx):
                     pdf_src.new_page(
-                        width=REMARKABLE_DOCUMENT.to_mm().to_mu().width,
-                        height=REMARKABLE_DOCUMENT.to_mm().to_mu().height,
+                        width=inserted_page_dims.width,
+                        height=inserted_page_dims.height,
                         pno=i,
                     )
 
@@ -61,9 +83,9 @@ class Document:
                     lambda _ann_page: _ann_page.stem == page, self.rm_annotation_files
                 )
                 path = next(paths, None)
-                if path:
+                if path and parse_pages:
                     try:
-                        page_sizes.append(determine_document_dimensions(path))
+                        page_sizes.append(self.parsed_page(page).dimensions)
                     except ValueError:
                         page_sizes.append(REMARKABLE_DOCUMENT)
                 else:
@@ -89,7 +111,8 @@ class Document:
             + [f.stem for f in self.rm_highlight_files]
         )
 
-        for page_uuid in page_uuids:
+        # In page order, so the output PDF can be assembled in one pass
+        for page_uuid in sorted(page_uuids, key=self.pages_list.index):
             has_annotations = False
             rm_annotation_file = None
 
@@ -3,6 +3,12 @@ import pathlib
 import argparse
 
 from remarks import run_remarks
+from remarks.cache import DEFAULT_CACHE_DIR, DEFAULT_CACHE_SIZE
+from remarks.conversion.parsing import STROKE_RENDER_COST
+from remarks.conversion.drawing import DEFAULT_PRECISION, DEFAULT_RASTER_DPI, DEFAULT_RASTER_THRESHOLD, RENDERERS
+from remarks.inkscape import DEFAULT_WORKERS
+from remarks.output.RemarksPdf import SAVE_PROFILES
+from remarks.watchdog import MEMORY_LIMITS_SUPPORTED
 
 __prog_name__ = "remarks"
 __version__ = "0.3.1"
@@ -34,6 +40,95 @@ def main():
         default="INFO",
         metavar="LOG_LEVEL",
     )
+    parser.add_argument(
+        "--cache_dir",
+        help=f"Cache parsed .rm pages in CACHE_DIR, so unchanged pages are not parsed again on the next run. For example: {DEFAULT_CACHE_DIR}. If not set, nothing is cached",
+        default=None,
+        metavar="CACHE_DIR",
+    )
+    parser.add_argument(
+        "--cache_size",
+        help="Maximum size of everything in CACHE_DIR in megabytes, parsed pages and rendered overlays together. Least recently used entries are removed first. Defaults to %(default)s",
+        default=DEFAULT_CACHE_SIZE // (1024 * 1024),
+        type=int,
+        metavar="MEGABYTES",
+    )
+    parser.add_argument(
+        "--simplify",
+        help="Simplify strokes before rendering, dropping points that are less than TOLERANCE typographic points (1/72 inch) away from the simplified stroke. Makes the PDFs smaller and faster to render, 0.1 to 0.5 is hard to tell apart at normal zoom levels. If not set, strokes are kept as recorded",
+        default=None,
+        type=float,
+        metavar="TOLERANCE",
+    )
+    parser.add_argument(
+        "--renderer",
+        help="How to render v6 pages. rmc: through an SVG converted by Inkscape. native: strokes and text are drawn straight into the PDF, which is much faster and does not need Inkscape. Defaults to %(default)s",
+        default="rmc",
+        choices=RENDERERS,
+    )
+    parser.add_argument(
+        "--precision",
+        help="Number of decimals the native renderer writes the coordinates of strokes with, in typographic points. Fewer decimals make smaller PDFs. Defaults to %(default)s",
+        default=DEFAULT_PRECISION,
+        type=int,
+        metavar="DECIMALS",
+    )
+    parser.add_argument(
+        "--raster_threshold",
+        help=f"Draw the annotations of pages whose cost is above COST as an image instead of as vectors, for pages that would be too heavy otherwise. The cost of a page is its number of points, plus {STROKE_RENDER_COST} for every stroke, 250000 only catches the pathological ones. If not set, annotations are always drawn as vectors",
+        default=DEFAULT_RASTER_THRESHOLD,
+        type=int,
+        metavar="COST",
+    )
+    parser.add_argument(
+        "--raster_dpi",
+        help="Resolution of the images of pages above the --raster_threshold, in dots per inch. Defaults to %(default)s",
+        default=DEFAULT_RASTER_DPI,
+        type=int,
+        metavar="DPI",
+    )
+    parser.add_argument(
+        "--inkscape_workers",
+        help="Number of Inkscape processes the rmc renderer keeps running to convert pages, instead of starting Inkscape for every page. 0 starts a new Inkscape for every page. When pages are rendered in processes of their own (see --jobs), each of those keeps one Inkscape running, unless this is 0. Defaults to %(default)s",
+        default=DEFAULT_WORKERS,
+        type=int,
+        metavar="WORKERS",
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        help="Number of processes to parse and render the pages of documents with, which are kept for all documents. Defaults to %(default)s",
+        default=1,
+        type=int,
+        metavar="JOBS",
+    )
+    parser.add_argument(
+        "--page_timeout",
+        help="Give up on rendering a page after SECONDS seconds, and put an error on it instead. Pages are then rendered in processes of their own, which also happens with more than one --jobs. If not set, pages can take as long as they take",
+        default=None,
+        type=float,
+        metavar="SECONDS",
+    )
+    parser.add_argument(
+        "--page_memory",
+        help="Give up on rendering a page when it needs more than MEGABYTES megabytes of memory (address space, on top of what remarks uses already), and put an error on it instead. Inkscape is not limited. Not supported on Windows. If not set, memory is not limited",
+        default=None,
+        type=int,
+        metavar="MEGABYTES",
+    )
+    parser.add_argument(
+        "--png_dpi",
+        help="Also export the annotated pages as PNG images at DPI dots per inch, into a directory next to the PDF. Pages that would be very large are exported in tiles. If not set, no PNGs are exported",
+        default=None,
+        type=int,
+        metavar="DPI",
+    )
+    parser.add_argument(
+        "--save_profile",
+        help="How to write the output PDFs. fast: as they are in memory, for batch jobs. compact: as small as possible, which takes longer. incremental: only append the pages that changed to the PDFs of an earlier run. Defaults to %(default)s",
+        default="default",
+        choices=SAVE_PROFILES,
+    )
     parser.add_argument(
         "-h",
         "--help",
@@ -47,12 +142,20 @@ def main():
     input_dir = args_dict.pop("input_dir")
     output_dir = args_dict.pop("output_dir")
 
+    args_dict["cache_size"] = args_dict["cache_size"] * 1024 * 1024
+
     log_level = args_dict.pop("log_level")
     logging.basicConfig(
         format="%(message)s",
         level=log_level,
     )
 
+    if args_dict["precision"] < 0:
+        parser.error("--precision can't be negative")
+
+    if args_dict["page_memory"] is not None and not MEMORY_LIMITS_SUPPORTED:
+        parser.error("--page_memory is not supported on this platform")
+
     if not pathlib.Path(input_dir).exists():
         parser.error(f'Directory "{input_dir}" does not exist')
 
@@ -0,0 +1,178 @@
+import hashlib
+import logging
+import os
+import pathlib
+import pickle
+import shutil
+import tempfile
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+
+DEFAULT_CACHE_DIR = pathlib.Path(os.environ.get("XDG_CACHE_HOME", pathlib.Path.home() / ".cache")) / "remarks"
+DEFAULT_CACHE_SIZE = 1024 * 1024 * 1024
+
+# Eviction makes room down to this share of the budget, so it doesn't have to run again on the next few puts
+EVICTION_TARGET = 0.9
+
+_cache_root: Optional[pathlib.Path] = None
+_cache_budget: Optional["CacheBudget"] = None
+_caches: Dict[str, "ContentCache"] = {}
+
+
+class CacheBudget:
+    """The size limit of all caches in a root directory, whatever their namespace.
+
+    The size of their entries is counted on the first put and then kept up to date. Entries other processes put in
+    meanwhile are counted when evicting, which counts again."""
+
+    def __init__(self, root: pathlib.Path, max_bytes: int):
+        self.root = pathlib.Path(root)
+        self.max_bytes = max_bytes
+        self._size: Optional[int] = None
+
+    def added(self, delta: int) -> None:
+        """Account for `delta` more bytes (or less, when negative), evicting when that goes over the budget"""
+        if self._size is None:
+            self._size = sum(size for _, size, _ in self._scan())
+        else:
+            self._size += delta
+        if self._size > self.max_bytes:
+            self.evict()
+
+    def evict(self) -> None:
+        """Remove the least recently used entries of any namespace until the caches take `EVICTION_TARGET` of
+        `max_bytes`"""
+        entries = self._scan()
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes * EVICTION_TARGET:
+                break
+            shutil.rmtree(path, ignore_errors=True)
+            total -= size
+        self._size = total
+
+    def _scan(self) -> List[Tuple[float, int, str]]:
+        """All entries, as (last used, size, path)"""
+        entries = []
+        for namespace in os.scandir(self.root):
+            if not namespace.is_dir():
+                continue
+            for bucket in os.scandir(namespace.path):
+                if not bucket.is_dir():
+                    continue
+                for entry in os.scandir(bucket.path):
+                    if not entry.name.startswith(".tmp-"):
+                        entries.append((entry.stat().st_mtime, _entry_size(entry.path), entry.path))
+        return entries
+
+
+class ContentCache:
+    """An on-disk, content-addressed cache with size-bounded LRU eviction.
+
+    Each entry is a directory holding a pickled metadata object and any number of NumPy arrays, stored as
+    .npy files so they can be memory-mapped back in instead of being read and copied.
+
+    Entries live in `<root>/<namespace>-v<version>`. Whenever the version of a namespace changes, the entries of
+    all other versions are removed, so a new parser never sees the output of an old one. All namespaces in a root
+    share one `CacheBudget`, so `max_bytes` limits the whole root."""
+
+    def __init__(
+            self, root: pathlib.Path, namespace: str, version: int, max_bytes: int = DEFAULT_CACHE_SIZE,
+            budget: Optional[CacheBudget] = None,
+    ):
+        self.root = pathlib.Path(root)
+        self.path = self.root / f"{namespace}-v{version}"
+        self.budget = budget if budget is not None else CacheBudget(self.root, max_bytes)
+
+        self.path.mkdir(parents=True, exist_ok=True)
+        for stale in self.root.glob(f"{namespace}-v*"):
+            if stale != self.path and stale.is_dir():
+                logging.info(f"- Removing outdated cache entries in {stale}")
+                shutil.rmtree(stale, ignore_errors=True)
+
+    @staticmethod
+    def key(*parts) -> str:
+        """Hash bytes-like objects (files, memory maps, ...) and anything with a stable repr into a key"""
+        digest = hashlib.blake2b(digest_size=20)
+        for part in parts:
+            if _is_buffer(part):
+                digest.update(part)
+            else:
+                digest.update(repr(part).encode())
+            digest.update(b"\0")
+        return digest.hexdigest()
+
+    def _entry(self, key: str) -> pathlib.Path:
+        return self.path / key[:2] / key
+
+    def get(self, key: str) -> Optional[Tuple[Any, Dict[str, np.ndarray]]]:
+        entry = self._entry(key)
+        try:
+            with open(entry / "meta.pickle", "rb") as f:
+                meta = pickle.load(f)
+            arrays = {
+                array_file.stem: np.load(array_file, mmap_mode="r")
+                for array_file in entry.glob("*.npy")
+            }
+            # Mark as recently used
+            os.utime(entry)
+        except (OSError, EOFError, pickle.UnpicklingError, ValueError):
+            return None
+        return meta, arrays
+
+    def put(self, key: str, meta: Any, arrays: Optional[Dict[str, np.ndarray]] = None, replace: bool = False) -> None:
+        """Store an entry. Content-addressed entries never change, so an existing entry is kept unless `replace`
+        is set, for entries keyed by something else than their content."""
+        entry = self._entry(key)
+        entry.parent.mkdir(parents=True, exist_ok=True)
+        replaced = 0
+        # Write next to the final location and rename, so readers never see half-written entries
+        staging = pathlib.Path(tempfile.mkdtemp(dir=entry.parent, prefix=".tmp-"))
+        try:
+            with open(staging / "meta.pickle", "wb") as f:
+                pickle.dump(meta, f, protocol=pickle.HIGHEST_PROTOCOL)
+            for name, array in (arrays or {}).items():
+                np.save(staging / f"{name}.npy", np.ascontiguousarray(array), allow_pickle=False)
+            size = _entry_size(staging)
+            if replace and entry.exists():
+                replaced = _entry_size(entry)
+                outdated = pathlib.Path(tempfile.mkdtemp(dir=entry.parent, prefix=".tmp-"))
+                os.rename(entry, outdated / entry.name)
+                shutil.rmtree(outdated, ignore_errors=True)
+            os.rename(staging, entry)
+        except OSError:
+            # Another process stored the same entry first
+            shutil.rmtree(staging, ignore_errors=True)
+            return
+
+        self.budget.added(size - replaced)
+
+
+def _entry_size(path) -> int:
+    return sum(f.stat().st_size for f in os.scandir(path))
+
+
+def _is_buffer(obj) -> bool:
+    try:
+        memoryview(obj)
+    except TypeError:
+        return False
+    return True
+
+
+def configure_cache(root=DEFAULT_CACHE_DIR, max_bytes: int = DEFAULT_CACHE_SIZE) -> None:
+    """Enable the on-disk caches, pass `None` as root to disable them again. `max_bytes` is shared by all of them."""
+    global _cache_root, _cache_budget
+    _cache_root = pathlib.Path(root).expanduser() if root is not None else None
+    _cache_budget = CacheBudget(_cache_root, max_bytes) if _cache_root is not None else None
+    _caches.clear()
+
+
+def get_cache(namespace: str, version: int) -> Optional[ContentCache]:
+    """The cache for `namespace`, or None when caching has not been enabled with `configure_cache`"""
+    if _cache_root is None:
+        return None
+    if namespace not in _caches:
+        _caches[namespace] = ContentCache(_cache_root, namespace, version, budget=_cache_budget)
+    return _caches[namespace]
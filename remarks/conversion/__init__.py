@@ -2,7 +2,16 @@ from .parsing import (
     parse_rm_file,
     rescale_parsed_data,
     get_ann_max_bound,
-    check_rm_file_version
+    check_rm_file_version,
+    parse_page,
+    probe_rm_file,
+    ParsedPage,
+    Strokes,
+)
+
+from .simplify import (
+    simplify_page,
+    SimplificationReport,
 )
 
 from .text import (
@@ -0,0 +1,218 @@
+import io
+import math
+import re
+from typing import List, Tuple
+
+import fitz  # PyMuPDF
+import numpy as np
+from rmc.exporters.svg import (
+    LINE_HEIGHTS,
+    SCREEN_HEIGHT,
+    SCREEN_WIDTH,
+    TEXT_TOP_Y,
+    tree_to_svg,
+)
+from rmc.exporters.writing_tools import RM_PALETTE
+from rmscene import SceneTree
+from rmscene.scene_items import ParagraphStyle, PenColor
+
+from .erase import erase_strokes
+from .parsing import ParsedPage, Strokes, TTextBlock, RM_TOOLS
+from ..dimensions import AffineTransform, RM_TO_PT
+
+RENDERERS = ("rmc", "native")
+
+# The color of the tablet highlighter, which rmc leaves out of its palette
+HIGHLIGHT_COLOR = (247, 232, 81)
+
+# Same fonts as the style sheet rmc puts in its SVGs
+TEXT_FONTS = {
+    ParagraphStyle.HEADING: ("tiro", 14),
+    ParagraphStyle.BOLD: ("hebo", 8),
+}
+DEFAULT_TEXT_FONT = ("helv", 7)
+
+# Pages with a `ParsedPage.render_cost` above a threshold can be drawn as an image rather than as vectors, see
+# `render_raster`. Off unless asked for, 250000 catches only the pathological pages
+DEFAULT_RASTER_THRESHOLD = None
+DEFAULT_RASTER_DPI = 300
+# Images of pages that are larger than this many pixels get a lower resolution instead
+MAX_RASTER_PIXELS = 50_000_000
+
+# Decimals of the stroke coordinates in the content stream, 1/100 pt is well below what anyone can see
+DEFAULT_PRECISION = 2
+# Consecutive strokes of a pen whose widths are within this ratio of each other are drawn with one width, which is
+# then off by at most 15%
+WIDTH_BAND = 1.3
+OPACITY_STEP = 0.05
+
+
+def annotations_view_box(page: ParsedPage) -> Tuple[float, float, float, float]:
+    """(x, y, width, height) in typographic points of the area rmc would render for a v6 page.
+
+    That is the screen of the tablet, grown to fit all strokes, in the same coordinates as the `viewBox` of
+    the SVGs rmc writes."""
+    x_min, x_max, y_min, y_max = -SCREEN_WIDTH // 2, SCREEN_WIDTH // 2, 0, SCREEN_HEIGHT
+    for layer in page.data["layers"]:
+        bounds = layer["strokes"].bounds()
+        if bounds is not None:
+            x_min, y_min = min(x_min, bounds[0]), min(y_min, bounds[1])
+            x_max, y_max = max(x_max, bounds[2]), max(y_max, bounds[3])
+
+    x, y = RM_TO_PT.apply_xy(x_min, y_min)
+    width, height = RM_TO_PT.apply_size(x_max - x_min + 1, y_max - y_min + 1)
+    return float(x), float(y), float(width), float(height)
+
+
+def render_svg(tree: SceneTree) -> Tuple[str, Tuple[float, float, float, float]]:
+    """The rmc SVG of a scene tree, along with its view box (x, y, width, height) in typographic points"""
+    output = io.StringIO()
+    tree_to_svg(tree, output)
+    svg = output.getvalue()
+
+    # The view box tree_to_svg computed is in the header it writes first, computing it again would take another
+    # pass over all points
+    x, y, width, height = map(float, SVG_VIEW_BOX.search(svg).group(1).split())
+    return svg, (x, y, width, height)
+
+
+SVG_VIEW_BOX = re.compile(r'viewBox="([^"]*)"')
+
+
+def render_pdf(
+        parsed_page: ParsedPage, precision: int = DEFAULT_PRECISION
+) -> Tuple[fitz.Document, Tuple[float, float, float, float]]:
+    """A one-page PDF with the annotations of a v6 page, the size of its view box, along with that view box"""
+    view_box = annotations_view_box(parsed_page)
+    doc = fitz.open()
+    page = doc.new_page(width=view_box[2], height=view_box[3])
+    draw_annotations(page, parsed_page, page.rect, precision)
+    return doc, view_box
+
+
+def render_raster(
+        parsed_page: ParsedPage, dpi: int = DEFAULT_RASTER_DPI
+) -> Tuple[fitz.Document, Tuple[float, float, float, float]]:
+    """Like `render_pdf`, but with the annotations as a transparent image at `dpi`.
+
+    For pages with so many points that vector output would be huge and slow to open, whichever renderer was
+    asked for. The annotations are drawn natively and rasterized by MuPDF, so no Inkscape is involved."""
+    vectors, view_box = render_pdf(parsed_page)
+    _, _, width, height = view_box
+    dpi = min(dpi, int(72 * math.sqrt(MAX_RASTER_PIXELS / (width * height))))
+    pixmap = vectors[0].get_pixmap(dpi=dpi, alpha=True)
+
+    doc = fitz.open()
+    page = doc.new_page(width=width, height=height)
+    page.insert_image(page.rect, pixmap=pixmap)
+    # Images with transparency are stored uncompressed
+    return fitz.open("pdf", doc.tobytes(deflate=True, deflate_images=True)), view_box
+
+
+def draw_annotations(
+        page: fitz.Page, parsed_page: ParsedPage, rect: fitz.Rect, precision: int = DEFAULT_PRECISION
+) -> None:
+    """Draw the strokes and the typed text of a v6 page onto `page`, in place of the rmc SVG.
+
+    `rect` is where the `annotations_view_box` ends up on `page`, at the same scale. Erasers take away the ink
+    below them, rather than being painted over it in white like rmc does."""
+    x, y, _, _ = annotations_view_box(parsed_page)
+    to_page = AffineTransform.translate(rect.x0 - x, rect.y0 - y) @ RM_TO_PT
+
+    if parsed_page.text is not None:
+        draw_text(page, parsed_page.text, to_page)
+    for layer in parsed_page.data["layers"]:
+        draw_strokes(page, erase_strokes(layer["strokes"]), to_page, precision)
+
+
+def draw_strokes(
+        page: fitz.Page, strokes: Strokes, transform: AffineTransform, precision: int = DEFAULT_PRECISION
+) -> None:
+    """Vector strokes with the width and opacity they were parsed with, widths are scaled like the points.
+
+    Consecutive strokes of the same tool and color share one path and one graphics state as long as their widths
+    stay within `WIDTH_BAND` of each other, the path is drawn with the width in the middle of the band. Pressure
+    makes every stroke of a pen slightly different, without the band almost nothing would be batched. Opacities
+    are rounded to `OPACITY_STEP`, and coordinates to `precision` decimals, which keeps the content stream of dense
+    handwriting short."""
+    shape = page.new_shape()
+    # The content stream is in PDF coordinates, with y going up
+    a, b, c, d, e, f = ~page.transformation_matrix
+    to_pdf = AffineTransform([[a, c, e], [b, d, f], [0, 0, 1]]) @ transform
+    points = to_pdf.apply(strokes.points.astype(np.float64)).round(precision)
+    tools = [RM_TOOLS[pen] for pen in strokes.tools.tolist()]
+    widths = transform.apply_length(strokes.widths.astype(np.float64))
+
+    style = None
+    thinnest = thickest = 0.0
+    for i in range(len(strokes)):
+        opacity = float(strokes.opacities[i])
+        start, end = strokes.offsets[i], strokes.offsets[i + 1]
+        if opacity <= 0 or end == start:
+            # Erase area strokes are invisible
+            continue
+        opacity = max(round(opacity / OPACITY_STEP) * OPACITY_STEP, OPACITY_STEP)
+        stroke_style = (tools[i], stroke_color(tools[i], int(strokes.colors[i])), opacity)
+        width = float(widths[i])
+        if style != stroke_style or max(thickest, width) > WIDTH_BAND * min(thinnest, width):
+            if style is not None:
+                finish_strokes(shape, *style, width=round((thinnest + thickest) / 2, 3))
+            style, thinnest, thickest = stroke_style, width, width
+        thinnest, thickest = min(thinnest, width), max(thickest, width)
+        shape.draw_cont += path_operators(points[start:end], precision)
+    if style is not None:
+        finish_strokes(shape, *style, width=round((thinnest + thickest) / 2, 3))
+    shape.commit()
+
+
+def finish_strokes(shape, tool: str, color: Tuple[float, float, float], opacity: float, width: float) -> None:
+    shape.finish(
+        width=width,
+        color=color,
+        stroke_opacity=opacity,
+        # Square caps for the highlighter like rmc, round for everything else
+        lineCap=2 if tool == "Highlighter" else 1,
+        lineJoin=1,
+        closePath=False,
+    )
+
+
+def path_operators(stroke: np.ndarray, precision: int) -> str:
+    """The `m` and `l` operators of a stroke, with its (n, 2) coordinates written with at most `precision`
+    decimals"""
+    numbers = [format_number(value, precision) for value in stroke.ravel().tolist()]
+    if len(numbers) == 2:
+        # A dot, the round caps make it visible
+        numbers *= 2
+    operators: List[str] = [f"{numbers[0]} {numbers[1]} m\n"]
+    operators.extend(f"{numbers[j]} {numbers[j + 1]} l\n" for j in range(2, len(numbers), 2))
+    return "".join(operators)
+
+
+def format_number(value: float, precision: int) -> str:
+    """A PDF number, which can't be in exponent notation, without trailing zeros"""
+    text = f"{value:.{precision}f}"
+    return text.rstrip("0").rstrip(".") if precision > 0 else text
+
+
+def stroke_color(tool: str, color: int) -> Tuple[float, float, float]:
+    if tool == "Eraser":
+        return 1, 1, 1
+    try:
+        rgb = RM_PALETTE[PenColor(color)]
+    except (KeyError, ValueError):
+        rgb = HIGHLIGHT_COLOR if tool == "Highlighter" else RM_PALETTE[PenColor.BLACK]
+    return tuple(c / 255 for c in rgb)
+
+
+def draw_text(page: fitz.Page, text: TTextBlock, transform: AffineTransform) -> None:
+    """The typed text of the page, laid out line by line the way rmc does it"""
+    y_offset = TEXT_TOP_Y
+    for paragraph in text["text"].contents:
+        y_offset += LINE_HEIGHTS.get(paragraph.style.value, 70)
+        line = str(paragraph).strip()
+        if not line:
+            continue
+        fontname, fontsize = TEXT_FONTS.get(paragraph.style.value, DEFAULT_TEXT_FONT)
+        x, y = transform.apply_xy(text["pos_x"], text["pos_y"] + y_offset)
+        page.insert_text(fitz.Point(float(x), float(y)), line, fontname=fontname, fontsize=fontsize)
@@ -0,0 +1,169 @@
+import numpy as np
+
+from .parsing import Strokes, stroke_bounding_boxes
+from .spatial import StrokeIndex
+
+# Pen codes, see `RM_TOOLS`
+ERASER = 6
+ERASE_AREA = 8
+
+# Eraser paths are compared piece by piece, so only the ink close to each piece has to be looked at
+PIECE_SIZE = 16
+
+# Roughly the number of point/eraser segment pairs compared at once, to bound the memory use
+CHUNK_SIZE = 1 << 18
+
+
+def erase_strokes(strokes: Strokes) -> Strokes:
+    """Apply the eraser strokes of a layer to the ink drawn before them.
+
+    `process_tool` draws erasers as wide strokes (or invisible ones, for the area eraser) on top of the ink,
+    so erased ink is emitted anyway. Instead, points covered by an eraser are removed here and strokes are split
+    where they have been erased through. Strokes that are erased completely disappear, and so do the erasers.
+
+    Ink drawn after an eraser stroke is never affected by it."""
+    is_eraser = np.isin(strokes.tools, (ERASER, ERASE_AREA))
+    if not is_eraser.any():
+        return strokes
+
+    stroke_of_point = np.repeat(np.arange(len(strokes)), strokes.point_counts())
+    point_alive = ~is_eraser[stroke_of_point]
+    # Whether the segment from a point to the next one in the same stroke is still there
+    segment_alive = np.ones(len(strokes.points), dtype=bool)
+
+    index = StrokeIndex(strokes.bboxes)
+    for eraser in np.flatnonzero(is_eraser):
+        path = strokes.stroke(eraser).astype(np.float64)
+        if len(path) == 0:
+            continue
+        if strokes.tools[eraser] == ERASER:
+            radius = float(strokes.widths[eraser]) / 2
+        else:
+            radius = 0.0
+            # The outline of the area, closed
+            path = np.concatenate((path, path[:1]))
+
+        candidates = index.query(*_bounds(path, radius))
+        candidates = candidates[(candidates < eraser) & ~is_eraser[candidates]]
+        if len(candidates) == 0:
+            continue
+        # The points of all candidates, and the segments between consecutive points of the same stroke
+        counts = strokes.point_counts()[candidates]
+        first = np.repeat(np.cumsum(counts) - counts, counts)
+        point_ids = np.repeat(strokes.offsets[:-1][candidates], counts) + np.arange(counts.sum()) - first
+        segment_ids = point_ids[:-1][stroke_of_point[point_ids[:-1]] == stroke_of_point[point_ids[1:]]]
+        points = strokes.points[point_ids]
+        p0, p1 = strokes.points[segment_ids], strokes.points[segment_ids + 1]
+
+        for piece_start in range(0, max(len(path) - 1, 1), PIECE_SIZE):
+            piece = path[piece_start:piece_start + PIECE_SIZE + 1]
+            box = _bounds(piece, radius)
+            a, b = (piece, piece) if len(piece) == 1 else (piece[:-1], piece[1:])
+
+            for ids in _chunks(segment_ids[_in_box(p0, p1, *box)], len(a)):
+                segment_alive[ids] &= ~_segments_near(
+                    strokes.points[ids].astype(np.float64), strokes.points[ids + 1].astype(np.float64), a, b, radius
+                )
+
+            if strokes.tools[eraser] == ERASER:
+                for ids in _chunks(point_ids[_in_box(points, points, *box)], len(a)):
+                    distances = _point_segment_distances(strokes.points[ids].astype(np.float64), a, b)
+                    point_alive[ids] &= distances.min(axis=1) > radius
+
+        if strokes.tools[eraser] == ERASE_AREA:
+            for ids in _chunks(point_ids[_in_box(points, points, *_bounds(path, 0))], len(path)):
+                point_alive[ids] &= ~_inside(strokes.points[ids].astype(np.float64), path)
+
+    return _split_runs(strokes, stroke_of_point, point_alive, segment_alive)
+
+
+def _bounds(path: np.ndarray, margin: float):
+    x_min, y_min = path.min(axis=0) - margin
+    x_max, y_max = path.max(axis=0) + margin
+    return x_min, y_min, x_max, y_max
+
+
+def _chunks(ids: np.ndarray, n_segments: int):
+    step = max(CHUNK_SIZE // n_segments, 1)
+    for start in range(0, len(ids), step):
+        yield ids[start:start + step]
+
+
+def _in_box(p0: np.ndarray, p1: np.ndarray, x_min: float, y_min: float, x_max: float, y_max: float) -> np.ndarray:
+    """Whether the bounding boxes of the segments p0[i]-p1[i] intersect the box"""
+    return (
+        (np.minimum(p0[:, 0], p1[:, 0]) <= x_max)
+        & (np.maximum(p0[:, 0], p1[:, 0]) >= x_min)
+        & (np.minimum(p0[:, 1], p1[:, 1]) <= y_max)
+        & (np.maximum(p0[:, 1], p1[:, 1]) >= y_min)
+    )
+
+
+def _inside(points: np.ndarray, outline: np.ndarray) -> np.ndarray:
+    """Whether the points are inside the closed outline, by the even-odd rule"""
+    a, b = outline[:-1], outline[1:]
+    # Count the crossings of a ray going right from every point
+    straddles = (a[:, 1] > points[:, 1:2]) != (b[:, 1] > points[:, 1:2])
+    with np.errstate(divide="ignore", invalid="ignore"):
+        x_cross = a[:, 0] + (points[:, 1:2] - a[:, 1]) * (b[:, 0] - a[:, 0]) / (b[:, 1] - a[:, 1])
+    return (straddles & (points[:, 0:1] < x_cross)).sum(axis=1) % 2 == 1
+
+
+def _segments_near(p0: np.ndarray, p1: np.ndarray, a: np.ndarray, b: np.ndarray, radius: float) -> np.ndarray:
+    """Whether the segments p0[i]-p1[i] cross or come within `radius` of any of the segments a[j]-b[j].
+
+    Only the ends of a[j]-b[j] are measured against p0[i]-p1[i]: the ends of p0[i]-p1[i] are points of the
+    stroke, when those are erased the segment is gone anyway."""
+    closest = np.minimum(
+        _point_segment_distances(a, p0, p1).min(axis=0),
+        _point_segment_distances(b, p0, p1).min(axis=0),
+    )
+    return _segments_intersect(p0, p1, a, b).any(axis=1) | (closest <= radius)
+
+
+def _point_segment_distances(points: np.ndarray, a: np.ndarray, b: np.ndarray) -> np.ndarray:
+    """(n_points, n_segments) distances"""
+    ab = b - a
+    length_sq = (ab ** 2).sum(axis=1)
+    ap = points[:, None, :] - a[None, :, :]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        t = np.where(length_sq > 0, (ap * ab).sum(axis=2) / length_sq, 0.0)
+    closest = a + np.clip(t, 0, 1)[:, :, None] * ab
+    return np.hypot(*(points[:, None, :] - closest).transpose(2, 0, 1))
+
+
+def _segments_intersect(p0: np.ndarray, p1: np.ndarray, q0: np.ndarray, q1: np.ndarray) -> np.ndarray:
+    """(n, m) whether segment p0[i]-p1[i] properly crosses segment q0[j]-q1[j]"""
+
+    def orientation(a, b, c):
+        return np.sign((b[..., 0] - a[..., 0]) * (c[..., 1] - a[..., 1]) - (b[..., 1] - a[..., 1]) * (c[..., 0] - a[..., 0]))
+
+    p0, p1 = p0[:, None, :], p1[:, None, :]
+    q0, q1 = q0[None, :, :], q1[None, :, :]
+    return (
+        (orientation(p0, p1, q0) * orientation(p0, p1, q1) < 0)
+        & (orientation(q0, q1, p0) * orientation(q0, q1, p1) < 0)
+    )
+
+
+def _split_runs(strokes: Strokes, stroke_of_point: np.ndarray, point_alive: np.ndarray, segment_alive: np.ndarray) -> Strokes:
+    """Turn every run of remaining, connected points into a stroke of its own"""
+    is_first = np.zeros(len(point_alive), dtype=bool)
+    is_first[strokes.offsets[:-1][strokes.point_counts() > 0]] = True
+    connected = np.zeros(len(point_alive), dtype=bool)
+    connected[1:] = ~is_first[1:] & point_alive[:-1] & segment_alive[:-1]
+    run_starts = np.flatnonzero(point_alive & ~connected)
+
+    kept = np.flatnonzero(point_alive)
+    offsets = np.searchsorted(kept, np.append(run_starts, len(point_alive))).astype(np.int64)
+    parents = stroke_of_point[run_starts]
+    points = strokes.points[kept]
+    return Strokes(
+        points=points,
+        offsets=offsets,
+        tools=strokes.tools[parents],
+        colors=strokes.colors[parents],
+        widths=strokes.widths[parents],
+        opacities=strokes.opacities[parents],
+        bboxes=stroke_bounding_boxes(points, offsets),
+    )
@@ -1,22 +1,33 @@
 import logging
 import math
+import mmap
+import os
+import pathlib
 import struct
+from contextlib import contextmanager
+from dataclasses import dataclass
 from enum import Enum
 from pprint import pprint
-from typing import Dict, List, Any, TypedDict, Tuple
-
-import shapely.geometry as geom  # Shapely
-from rmscene import read_blocks, SceneTree, build_tree, RootTextBlock, LwwValue
-from rmscene.scene_items import Line, GlyphRange, Rectangle, ParagraphStyle, END_MARKER
+from typing import BinaryIO, Dict, Iterator, List, Sequence, TypedDict, Tuple
+
+import numpy as np
+from rmc.exporters.svg import build_anchor_pos, get_anchor
+from rmc.exporters.writing_tools import Pen as RmcPen
+from rmscene import SceneTree, build_tree, LwwValue, Block, SceneLineItemBlock, CrdtId
+from rmscene.crdt_sequence import CrdtSequenceItem
+from rmscene.tagged_block_common import UnexpectedBlockError
+from rmscene.tagged_block_reader import TaggedBlockReader
+from rmscene.scene_items import Group, Line, Point, Pen, PenColor, GlyphRange, Rectangle, ParagraphStyle, END_MARKER
 from rmscene.text import TextDocument
 
+from ..cache import ContentCache, get_cache
 from ..metadata import ReMarkableAnnotationsFileHeaderVersion
 from ..utils import (
     RM_WIDTH,
     RM_HEIGHT,
 )
 
-from ..dimensions import ReMarkableDimensions, REMARKABLE_DOCUMENT
+from ..dimensions import AffineTransform, ReMarkableDimensions, REMARKABLE_DOCUMENT
 
 # reMarkable tools
 # http://web.archive.org/web/20190806120447/https://support.remarkable.com/hc/en-us/articles/115004558545-5-1-Tools-Overview
@@ -82,40 +93,144 @@ def process_tool(pen, dims, w, opc):
     return name_code, w, opc
 
 
-def adjust_xypos_sizes(xpos, ypos, dims: ReMarkableDimensions):
+def xypos_transform(dims: ReMarkableDimensions) -> AffineTransform:
+    """From the coordinates in v3/v5 .rm files to the coordinates on a page of `dims`"""
     ratio = (dims.height / dims.height) / (RM_HEIGHT / RM_WIDTH)
 
     if ratio > 1:
-        xpos = ratio * ((xpos * dims.height) / RM_WIDTH)
-        ypos = (ypos * dims.height) / RM_HEIGHT
-    else:
-        xpos = (xpos * dims.height) / RM_WIDTH
-        ypos = (1 / ratio) * (ypos * dims.height) / RM_HEIGHT
-
-    return xpos, ypos
-
+        return AffineTransform.scale(ratio * dims.height / RM_WIDTH, dims.height / RM_HEIGHT)
+    return AffineTransform.scale(dims.height / RM_WIDTH, (1 / ratio) * dims.height / RM_HEIGHT)
 
-def update_stroke_dict(st, tool):
-    st[tool] = {}
-    st[tool]["segments"] = []
-    return st
 
+def adjust_xypos_sizes(xpos, ypos, dims: ReMarkableDimensions):
+    """Works on single coordinates as well as on whole NumPy arrays of them"""
+    return xypos_transform(dims).apply_xy(xpos, ypos)
+
+
+@dataclass
+class Strokes:
+    """All strokes of a layer, stored column-wise.
+
+    Stroke `i` consists of the points `points[offsets[i]:offsets[i + 1]]`, and is drawn with
+    `tools[i]`, `colors[i]`, `widths[i]` and `opacities[i]`."""
+
+    points: np.ndarray
+    """(n_points, 2) float32 x/y coordinates"""
+
+    offsets: np.ndarray
+    """(n_strokes + 1,) int64 start of each stroke in `points`"""
+
+    tools: np.ndarray
+    """(n_strokes,) uint8 reMarkable pen codes, see `RM_TOOLS`"""
+
+    colors: np.ndarray
+    """(n_strokes,) int16 reMarkable color codes"""
+
+    widths: np.ndarray
+    """(n_strokes,) float32 stroke widths, in the units of the points for v6 pages (see `rmc_stroke_width`), as
+    computed by `process_tool` for v3 and v5 pages"""
+
+    opacities: np.ndarray
+    """(n_strokes,) float32 opacities, as computed by `process_tool`"""
+
+    bboxes: np.ndarray
+    """(n_strokes, 4) float32 x_min, y_min, x_max, y_max of each stroke, NaN for strokes without points"""
+
+    def __len__(self) -> int:
+        return len(self.tools)
+
+    def stroke(self, i: int) -> np.ndarray:
+        return self.points[self.offsets[i]:self.offsets[i + 1]]
+
+    def point_counts(self) -> np.ndarray:
+        return np.diff(self.offsets)
+
+    def tool_names(self) -> List[str]:
+        return [f"{RM_TOOLS[pen]}_{pen}" for pen in self.tools.tolist()]
+
+    def set_points(self, points: np.ndarray) -> None:
+        """Replace the coordinates (e.g. after a transformation), keeping the bounding boxes in sync"""
+        self.points = points.astype(np.float32, copy=False)
+        self.bboxes = stroke_bounding_boxes(self.points, self.offsets)
+
+    def bounds(self, min_points: int = 1) -> Tuple[float, float, float, float] | None:
+        """x_min, y_min, x_max, y_max over all strokes with at least `min_points` points"""
+        bboxes = self.bboxes[self.point_counts() >= max(min_points, 1)]
+        if len(bboxes) == 0:
+            return None
+        x_min, y_min = bboxes[:, :2].min(axis=0).tolist()
+        x_max, y_max = bboxes[:, 2:].max(axis=0).tolist()
+        return x_min, y_min, x_max, y_max
+
+    def keep_points(self, mask: np.ndarray) -> "Strokes":
+        """Only the points where `mask` is set (e.g. after simplification), as a new `Strokes`"""
+        # The number of kept points before each point, looked up at the old stroke starts
+        kept_before = np.zeros(len(mask) + 1, dtype=np.int64)
+        np.cumsum(mask, out=kept_before[1:])
+        offsets = kept_before[self.offsets]
+        points = self.points[mask]
+        return Strokes(
+            points=points,
+            offsets=offsets,
+            tools=self.tools,
+            colors=self.colors,
+            widths=self.widths,
+            opacities=self.opacities,
+            bboxes=stroke_bounding_boxes(points, offsets),
+        )
 
-def create_seg_dict(opacity, stroke_width, cc):
-    sg = {}
-    sg["style"] = {}
-    sg["style"]["opacity"] = f"{opacity:.3f}"
-    sg["style"]["stroke-width"] = f"{stroke_width:.3f}"
-    sg["style"]["color-code"] = cc
-    sg["points"] = []
-    return sg
+    @classmethod
+    def empty(cls) -> "Strokes":
+        return StrokesBuilder().build()
+
+
+class StrokesBuilder:
+    """Collects strokes one by one, then concatenates them into a `Strokes` in one go"""
+
+    def __init__(self):
+        self._points: List[np.ndarray] = []
+        self._tools: List[int] = []
+        self._colors: List[int] = []
+        self._widths: List[float] = []
+        self._opacities: List[float] = []
+
+    def add(self, pen: int, color: int, width: float, opacity: float, points: np.ndarray):
+        self._points.append(points)
+        self._tools.append(pen)
+        self._colors.append(color)
+        self._widths.append(width)
+        self._opacities.append(opacity)
+
+    def build(self) -> Strokes:
+        offsets = np.zeros(len(self._points) + 1, dtype=np.int64)
+        np.cumsum([len(p) for p in self._points], out=offsets[1:])
+        if self._points:
+            points = np.concatenate(self._points).astype(np.float32, copy=False)
+        else:
+            points = np.empty((0, 2), dtype=np.float32)
+        points = points.reshape(-1, 2)
+        return Strokes(
+            points=points,
+            offsets=offsets,
+            tools=np.array(self._tools, dtype=np.uint8),
+            colors=np.array(self._colors, dtype=np.int16),
+            widths=np.array(self._widths, dtype=np.float32),
+            opacities=np.array(self._opacities, dtype=np.float32),
+            bboxes=stroke_bounding_boxes(points, offsets),
+        )
 
 
-def update_boundaries_from_point(x, y, boundaries):
-    boundaries["x_max"] = max(boundaries["x_max"], x)
-    boundaries["y_max"] = max(boundaries["y_max"], y)
-    boundaries["x_min"] = min(boundaries["x_min"], x)
-    boundaries["y_min"] = min(boundaries["y_min"], y)
+def stroke_bounding_boxes(points: np.ndarray, offsets: np.ndarray) -> np.ndarray:
+    """Per-stroke min/max reductions over the coordinate array"""
+    counts = np.diff(offsets)
+    bboxes = np.full((len(counts), 4), np.nan, dtype=np.float32)
+    has_points = counts > 0
+    # Strokes without points contribute nothing to `points`, so the starts of the others delimit them exactly
+    starts = offsets[:-1][has_points]
+    if len(starts) > 0:
+        bboxes[has_points, :2] = np.minimum.reduceat(points, starts, axis=0)
+        bboxes[has_points, 2:] = np.maximum.reduceat(points, starts, axis=0)
+    return bboxes
 
 
 class TRemarksRectangle:
@@ -124,7 +239,7 @@ class TRemarksRectangle:
 
 
 class TLayer(TypedDict):
-    strokes: Dict[str, Any]
+    strokes: Strokes
     rectangles: List[TRemarksRectangle]
 
 
@@ -148,61 +263,316 @@ class TextStyles(Enum):
     ITALIC_CLOSE = 4
 
 
+def read_scene(data: BinaryIO, tree: SceneTree | None = None, offset: int = 0) -> Tuple[SceneTree, int]:
+    """Decode the blocks of a v6 .rm file and build its scene tree.
+
+    Blocks are applied to the tree as they are decoded and not kept around, so memory use grows with the
+    contents of the page rather than with the length of its history.
+
+    To resume reading a file that has been appended to, pass the tree and offset returned by an earlier call,
+    only the blocks after `offset` are decoded then. Returns the tree and the offset just after the last block."""
+    if tree is None:
+        tree = SceneTree()
+        offset = None
+    end = offset
+
+    def applied_blocks() -> Iterator[Block]:
+        nonlocal end
+        for block, end in iter_blocks(data, offset):
+            yield block
+
+    build_tree(tree, applied_blocks())
+    if end is None:
+        end = data.tell()
+    return tree, end
+
+
+def iter_blocks(data: BinaryIO, offset: int | None = None) -> Iterator[Tuple[Block, int]]:
+    """The blocks of a v6 .rm file one by one, each with the offset just after it.
+
+    Starts after the header, or at `offset` (which has to be the end of a block) when given."""
+    stream = TaggedBlockReader(data)
+    if offset is None:
+        data.seek(0)
+        stream.read_header()
+    else:
+        data.seek(offset)
+    while (block := read_block(stream)) is not None:
+        yield block, data.tell()
+
+
+V6_BLOCK_HEADER = struct.Struct("<IBBBB")
+
+# The point formats of line items, by block version. See `rmscene.scene_stream.point_from_stream`
+V6_POINT_DTYPES = {
+    1: np.dtype([("x", "<f4"), ("y", "<f4"), ("speed", "<f4"), ("direction", "<f4"), ("width", "<f4"), ("pressure", "<f4")]),
+    2: np.dtype([("x", "<f4"), ("y", "<f4"), ("speed", "<u2"), ("width", "<u2"), ("direction", "u1"), ("pressure", "u1")]),
+}
+
+
+class PointArray(Sequence):
+    """The points of a line as a NumPy structured array, with the fields of `rmscene.scene_items.Point`.
+
+    Stands in for the list of points rmscene would produce, `Point` objects are only created when the points
+    are accessed one by one (e.g. by rmc). Indexing with a slice or mask gives a `PointArray` again."""
+
+    FIELDS = ["x", "y", "speed", "direction", "width", "pressure"]
+
+    def __init__(self, array: np.ndarray):
+        self.array = array
+
+    def __len__(self) -> int:
+        return len(self.array)
+
+    def __getitem__(self, index):
+        if isinstance(index, (int, np.integer)):
+            return Point(*self.array[self.FIELDS][index].tolist())
+        return PointArray(self.array[index])
+
+    def __iter__(self) -> Iterator[Point]:
+        for values in self.array[self.FIELDS].tolist():
+            yield Point(*values)
+
+    def xy(self) -> np.ndarray:
+        """(n_points, 2) float32 x/y coordinates"""
+        return np.stack((self.array["x"], self.array["y"]), axis=1)
+
+    @classmethod
+    def decode(cls, payload: bytes, version: int) -> "PointArray":
+        points = np.frombuffer(payload, dtype=V6_POINT_DTYPES[version])
+        if version == 1:
+            # Convert to the units of version 2, the same way rmscene does
+            converted = np.empty(len(points), dtype=[
+                ("x", "<f4"), ("y", "<f4"), ("speed", "<f8"), ("direction", "<f8"), ("width", "<i8"), ("pressure", "<f8"),
+            ])
+            converted["x"] = points["x"]
+            converted["y"] = points["y"]
+            converted["speed"] = points["speed"].astype(np.float64) * 4
+            converted["direction"] = 255 * points["direction"].astype(np.float64) / (math.pi * 2)
+            converted["width"] = np.round(points["width"].astype(np.float64) * 4)
+            converted["pressure"] = points["pressure"].astype(np.float64) * 255
+            points = converted
+        return cls(points)
+
+
+def line_points_xy(points) -> np.ndarray:
+    if isinstance(points, PointArray):
+        return points.xy()
+    return np.array([(p.x, p.y) for p in points], dtype=np.float32).reshape(-1, 2)
+
+
+def read_block(stream: TaggedBlockReader) -> Block | None:
+    """`Block.read`, decoding the points of line items straight into arrays.
+
+    Line items make up almost all of a handwritten page, and rmscene reads their points one value at a time.
+    Anything else, or anything unexpected in a line item, is left to rmscene."""
+    data = stream.data.data
+    start = data.tell()
+    header = data.read(V6_BLOCK_HEADER.size)
+    data.seek(start)
+    if len(header) == V6_BLOCK_HEADER.size:
+        _, _, _, version, block_type = V6_BLOCK_HEADER.unpack(header)
+        if block_type == SceneLineItemBlock.BLOCK_TYPE and version in V6_POINT_DTYPES:
+            try:
+                with stream.read_block() as block_info:
+                    block = line_item_block_from_stream(stream, version)
+                block.extra_data = block_info.extra_data
+                return block
+            except Exception as e:
+                logging.debug(f"Leaving the line item at {start} to rmscene: {e!r}")
+                stream.current_block = None
+                data.seek(start)
+    return Block.read(stream)
+
+
+def line_item_block_from_stream(stream: TaggedBlockReader, version: int) -> SceneLineItemBlock:
+    """`SceneLineItemBlock.from_stream`, see `read_block`"""
+    parent_id = stream.read_id(1)
+    item_id = stream.read_id(2)
+    left_id = stream.read_id(3)
+    right_id = stream.read_id(4)
+    deleted_length = stream.read_int(5)
+
+    if stream.has_subblock(6):
+        with stream.read_subblock(6) as block_info:
+            item_type = stream.data.read_uint8()
+            if item_type != SceneLineItemBlock.ITEM_TYPE:
+                raise ValueError(f"Unexpected item type {item_type}")
+            value = line_from_stream(stream, version)
+        extra_value_data = block_info.extra_data
+    else:
+        value = None
+        extra_value_data = b""
+
+    return SceneLineItemBlock(
+        parent_id,
+        CrdtSequenceItem(item_id, left_id, right_id, deleted_length, value),
+        extra_value_data=extra_value_data,
+    )
+
+
+def line_from_stream(stream: TaggedBlockReader, version: int) -> Line:
+    """`rmscene.scene_stream.line_from_stream`, with the points in a `PointArray`"""
+    tool = Pen(stream.read_int(1))
+    color = PenColor(stream.read_int(2))
+    thickness_scale = stream.read_double(3)
+    starting_length = stream.read_float(4)
+    with stream.read_subblock(5) as block_info:
+        if block_info.size % V6_POINT_DTYPES[version].itemsize != 0:
+            raise ValueError(f"Point data size mismatch: {block_info.size}")
+        points = PointArray.decode(stream.data.read_bytes(block_info.size), version)
+
+    # The timestamp is not used
+    stream.read_id(6)
+
+    move_id: CrdtId | None = None
+    if stream.bytes_remaining_in_block() >= 3:
+        try:
+            move_id = stream.read_id(7)
+        except UnexpectedBlockError:
+            pass
+
+    return Line(color, tool, points, thickness_scale, starting_length, move_id)
+
+
+@dataclass
+class SceneCheckpoint:
+    """The scene tree of a v6 file after reading its first `offset` bytes"""
+
+    tree: SceneTree
+    offset: int
+    prefix_hash: str
+
+
+# Bump this whenever the checkpoints can no longer be resumed from, e.g. after an rmscene upgrade
+SCENE_CHECKPOINT_VERSION = 2
+
+
+def read_scene_resuming(file_path, mm: mmap.mmap) -> SceneTree:
+    """`read_scene`, continuing from where the previous read of `file_path` stopped.
+
+    xochitl appends blocks to a v6 page as it is being written on, so as long as the bytes read last time
+    are unchanged, only the new blocks need to be decoded. Checkpoints are kept in the "scenes" cache,
+    without a cache the whole file is read every time."""
+    cache = get_cache("scenes", SCENE_CHECKPOINT_VERSION)
+    if cache is None:
+        return read_scene(mm)[0]
+
+    key = cache.key(str(pathlib.Path(file_path).resolve()))
+    tree, offset = None, 0
+    cached = cache.get(key)
+    if cached is not None:
+        checkpoint, _ = cached
+        if checkpoint.offset <= len(mm) and prefix_hash(mm, checkpoint.offset) == checkpoint.prefix_hash:
+            tree, offset = checkpoint.tree, checkpoint.offset
+        else:
+            logging.debug(f"{file_path} was rewritten since it was last read, reading it from the start")
+
+    resumed = tree is not None
+    tree, end = read_scene(mm, tree, offset)
+    if not resumed or end != offset:
+        cache.put(key, SceneCheckpoint(tree, end, prefix_hash(mm, end)), replace=True)
+    return tree
+
+
+def prefix_hash(mm: mmap.mmap, length: int) -> str:
+    # The views have to be released before the map can be closed
+    with memoryview(mm) as view, view[:length] as prefix:
+        return ContentCache.key(prefix)
+
+
 def parse_v6(file_path: str) -> Tuple[TLayers, bool]:
+    with open(file_path, "rb") as f:
+        tree, _ = read_scene(f)
+    return parse_v6_scene(tree), False
+
+
+def parse_v6_scene(tree: SceneTree, dims: ReMarkableDimensions = REMARKABLE_DOCUMENT) -> TLayers:
     output: TLayers = {
-        "layers": [{"strokes": {}, "rectangles": []}],
+        "layers": [{"strokes": Strokes.empty(), "rectangles": []}],
         "highlights": [],
         "text": None,
     }
+    strokes = StrokesBuilder()
+
+    try:
+        if tree.root_text is not None:
+            output["text"] = {
+                "pos_x": tree.root_text.pos_x,
+                "pos_y": tree.root_text.pos_y,
+                "width": tree.root_text.width,
+                "text": TextDocument.from_scene_item(tree.root_text),
+            }
+        for el, (anchor_x, anchor_y) in walk_anchored(tree):
+            if isinstance(el, GlyphRange):
+                layer = output["layers"][0]
+                highlight: TRemarksRectangle = {
+                    "rectangles": el.rectangles,
+                    "color": el.color.value,
+                }
+                layer["rectangles"].append(highlight)
+                output["highlights"].append(el)
+            if isinstance(el, Line):
+                if el.points is None:
+                    break
+                pen = el.tool.value
+                color = el.color.value
+                opacity = 1
+
+                _, _, opacity = process_tool(
+                    pen, dims, el.thickness_scale, opacity
+                )
+                stroke_width = rmc_stroke_width(el)
+                points = line_points_xy(el.points)
+                if anchor_x or anchor_y:
+                    points = points + np.array((anchor_x, anchor_y), dtype=points.dtype)
+                strokes.add(pen, color, stroke_width, opacity, points)
+    except AssertionError:
+        print("ReMarkable broken data")
+
+    output["layers"][0]["strokes"] = strokes.build()
+    return output
+
+
+def rmc_stroke_width(line: Line) -> float:
+    """The width rmc draws a v6 line with, in screen units like its points.
+
+    rmc sets the width again every `segment_length` points, from the pressure, speed and tilt there, this is the
+    average over the whole line."""
+    try:
+        pen = RmcPen.create(line.tool.value, line.color.value, line.thickness_scale)
+    except KeyError:
+        # A color rmc has no palette entry for, which does not change the width
+        pen = RmcPen.create(line.tool.value, PenColor.BLACK.value, line.thickness_scale)
+
+    n = len(line.points)
+    if n == 0:
+        return float(pen.base_width)
+    total = width = 0.0
+    for start in range(0, n, pen.segment_length):
+        point = line.points[start]
+        width = pen.get_segment_width(point.speed, point.direction, point.width, point.pressure, width)
+        total += width * min(pen.segment_length, n - start)
+    return total / n
+
+
+def walk_anchored(tree: SceneTree) -> Iterator[Tuple[object, Tuple[float, float]]]:
+    """Like `SceneTree.walk`, along with the offset of the groups each item is in.
+
+    Groups can be anchored to a line of the root text, rmc translates them by that anchor when drawing,
+    so the strokes are moved the same way to end up where they are rendered."""
+    anchor_pos = build_anchor_pos(tree.root_text)
+
+    def walk(item, offset):
+        if isinstance(item, Group):
+            anchor_x, anchor_y = get_anchor(item, anchor_pos)
+            offset = (offset[0] + anchor_x, offset[1] + anchor_y)
+            for child in item.children.values():
+                yield from walk(child, offset)
+        else:
+            yield item, offset
 
-    dims = determine_document_dimensions(file_path)
-
-    with open(file_path, "rb") as f:
-        tree = SceneTree()
-        blocks = [b for b in read_blocks(f)]
-        build_tree(tree, blocks)
-
-        try:
-            for block in blocks:
-                if isinstance(block, RootTextBlock):
-                    output["text"] = {
-                        "pos_x": block.value.pos_x,
-                        "pos_y": block.value.pos_y,
-                        "width": block.value.width,
-                        "text": TextDocument.from_scene_item(tree.root_text),
-                    }
-            for el in tree.walk():
-                if isinstance(el, GlyphRange):
-                    layer = output["layers"][0]
-                    highlight: TRemarksRectangle = {
-                        "rectangles": el.rectangles,
-                        "color": el.color.value,
-                    }
-                    layer["rectangles"].append(highlight)
-                    output["highlights"].append(el)
-                if isinstance(el, Line):
-                    layer = output["layers"][0]
-
-                    if el.points is None:
-                        break
-                    pen = el.tool.value
-                    color = el.color.value
-                    opacity = 1
-                    stroke_width = el.thickness_scale
-
-                    tool, stroke_width, opacity = process_tool(
-                        pen, dims, stroke_width, opacity
-                    )
-                    segment = create_seg_dict(opacity, stroke_width, color)
-                    points_ = [(f"{p.x:.3f}", f"{p.y:.3f}") for p in el.points]
-                    segment["points"].append(points_)
-                    if tool not in layer["strokes"].keys():
-                        layer["strokes"] = update_stroke_dict(layer["strokes"], tool)
-                    layer["strokes"][tool]["segments"].append(segment)
-        except AssertionError:
-            print("ReMarkable broken data")
-
-    return output, False
+    yield from walk(tree.root, (0.0, 0.0))
 
 
 class UnexpectedTextStylingException(Exception):
@@ -239,85 +609,99 @@ def rounddown(num, increment):
 def determine_document_dimensions(file_path) -> ReMarkableDimensions:
     """The ReMarkable has dynamic document size in v6. The dimensions are not available anywhere, so we'll compute
     them from points"""
+    page = parse_page(file_path)
+    if page.version != ReMarkableAnnotationsFileHeaderVersion.V6:
+        raise ValueError(f"{file_path} is not a v6 .rm file")
+    return page.dimensions
+
+
+def determine_strokes_dimensions(strokes: Strokes) -> ReMarkableDimensions:
+    """Same as `determine_document_dimensions`, computed from already parsed strokes"""
     # This is the horizontal space you get as defined by ReMarkable.
     # Not coincidentally, this is (RM_HEIGHT - RM_WIDTH)/2
     # Adding two increments, which is the max, you end up with an exactly square aspect ratio
     # hori = (RM_HEIGHT - RM_WIDTH) / 2
-    dims = {
-        "x_min": -RM_WIDTH / 2,
-        "x_max": RM_WIDTH / 2 - 1,
-        "y_min": 0,
-        "y_max": RM_HEIGHT - 1,
-    }
-    with open(file_path, "rb") as f:
-        blocks = read_blocks(f)
-        tree = SceneTree()
-        build_tree(tree, blocks)
+    x_min, y_min, x_max, y_max = -RM_WIDTH / 2, 0, RM_WIDTH / 2 - 1, RM_HEIGHT - 1
 
-        try:
-            for el in tree.walk():
-                if isinstance(el, Line):
-                    for p in el.points:
-                        update_boundaries_from_point(p.x, p.y, dims)
-        except AssertionError:
-            print("ReMarkable broken data")
-
-    return ReMarkableDimensions(
-        dims["x_max"] - dims["x_min"], dims["y_max"] - dims["y_min"]
-    )
+    bounds = strokes.bounds()
+    if bounds is not None:
+        x_min, y_min = min(x_min, bounds[0]), min(y_min, bounds[1])
+        x_max, y_max = max(x_max, bounds[2]), max(y_max, bounds[3])
 
+    return ReMarkableDimensions(x_max - x_min, y_max - y_min)
 
-def read_rm_file_version(file_path: str) -> ReMarkableAnnotationsFileHeaderVersion:
-    with open(file_path, "rb") as f:
-        src_header = f.readline()
-
-        # 32nd character (marked with V) is the version number
-        #                                                       V
-        expected_header_fmt = b"reMarkable .lines file, version=0          "
-        fmt = f"<{len(expected_header_fmt)}sI"
-        header, nlayers = struct.unpack_from(fmt, src_header, 0)
-        # 32nd character is the version number
-        version = chr(header[32])
-
-        if version == "3":
-            return ReMarkableAnnotationsFileHeaderVersion.V3
-        elif version == "6":
-            return ReMarkableAnnotationsFileHeaderVersion.V6
-        else:
-            return ReMarkableAnnotationsFileHeaderVersion.UNKNOWN
 
+RM_HEADER = struct.Struct(f"<{len(b'reMarkable .lines file, version=0          ')}sI")
 
+RM_HEADER_VERSIONS = {
+    b"reMarkable .lines file, version=3          ": ReMarkableAnnotationsFileHeaderVersion.V3,
+    b"reMarkable .lines file, version=5          ": ReMarkableAnnotationsFileHeaderVersion.V5,
+    b"reMarkable .lines file, version=6          ": ReMarkableAnnotationsFileHeaderVersion.V6,
+}
 
 
+@dataclass(frozen=True)
+class RmFileHeader:
+    version: str
+    """One of the `ReMarkableAnnotationsFileHeaderVersion` values"""
 
-def check_rm_file_version(file_path):
+    nlayers: int
+    """Only meaningful for v3 and v5, in v6 these bytes are already part of the first block"""
+
+    size: int
+    """Size of the whole file in bytes"""
+
+    header: bytes
+
+
+@contextmanager
+def open_rm_file(file_path) -> Iterator[Tuple[RmFileHeader, mmap.mmap | None]]:
+    """Memory-maps an .rm file and decodes its header.
+
+    The mapping is `None` when the file is too short to even contain a header. Nothing beyond the pages that
+    are actually touched is read from disk, so this is cheap enough to call just to find out the version."""
     with open(file_path, "rb") as f:
-        data = f.read()
+        size = os.fstat(f.fileno()).st_size
+        if size < RM_HEADER.size:
+            yield RmFileHeader(ReMarkableAnnotationsFileHeaderVersion.UNKNOWN, 0, size, b""), None
+            return
 
-    expected_header_fmt = b"reMarkable .lines file, version=0          "
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            header, nlayers = RM_HEADER.unpack_from(mm, 0)
+            version = RM_HEADER_VERSIONS.get(header, ReMarkableAnnotationsFileHeaderVersion.UNKNOWN)
+            yield RmFileHeader(version, nlayers, size, header), mm
+        finally:
+            try:
+                mm.close()
+            except BufferError:
+                # Arrays still point into the mapping, typically from the frames of an exception that is on its
+                # way up. That exception is the one to report, the mapping goes away with the last of them.
+                pass
 
-    if len(data) < len(expected_header_fmt) + 4:
-        logging.error(f"- .rm file ({file_path}) seems too short to be valid")
-        return False
 
-    offset = 0
-    fmt = f"<{len(expected_header_fmt)}sI"
+def probe_rm_file(file_path) -> RmFileHeader:
+    with open_rm_file(file_path) as (header, _):
+        return header
+
+
+def read_rm_file_version(file_path: str) -> ReMarkableAnnotationsFileHeaderVersion:
+    return probe_rm_file(file_path).version
+
 
-    header, nlayers = struct.unpack_from(fmt, data, offset)
+def check_rm_file_version(file_path):
+    header = probe_rm_file(file_path)
 
-    is_v3 = header == b"reMarkable .lines file, version=3          "
-    is_v5 = header == b"reMarkable .lines file, version=5          "
-    is_v6 = header == b"reMarkable .lines file, version=6          "
+    if header.size < RM_HEADER.size:
+        logging.error(f"- .rm file ({file_path}) seems too short to be valid")
+        return False
 
-    if is_v6:
+    if header.version == ReMarkableAnnotationsFileHeaderVersion.V6:
         return True
-        # logging.error(
-        #     f"- Found a v6 .rm file ({file_path}) created with reMarkable software >= 3.0. Unfortunately we do not support this version yet. More info: https://github.com/lucasrla/remarks/issues/58"
-        # )
 
-    if (not is_v3 and not is_v5) or nlayers < 1:
+    if header.version == ReMarkableAnnotationsFileHeaderVersion.UNKNOWN or header.nlayers < 1:
         logging.error(
-            f"- .rm file ({file_path}) doesn't look like a valid one: <header={header}><nlayers={nlayers}>"
+            f"- .rm file ({file_path}) doesn't look like a valid one: <header={header.header}><nlayers={header.nlayers}>"
         )
         return False
 
@@ -325,87 +709,229 @@ def check_rm_file_version(file_path):
 
 
 def parse_rm_file(file_path: str, dims=None) -> Tuple[Tuple[TLayers, bool], str]:
-    if dims is None:
-        dims = REMARKABLE_DOCUMENT
-    with open(file_path, "rb") as f:
-        data = f.read()
+    page = parse_page(file_path, dims)
+    if page.version == ReMarkableAnnotationsFileHeaderVersion.V6:
+        return (page.data, page.has_highlighter), "V6"
+    return (page.data, page.has_highlighter), "V5"
+
+
+# Every stroke is a path with a graphics state of its own in the output, which costs about as much as this many points
+STROKE_RENDER_COST = 20
 
-    expected_header_fmt = b"reMarkable .lines file, version=0          "
 
-    expected_header_v3 = b"reMarkable .lines file, version=3          "
-    expected_header_v5 = b"reMarkable .lines file, version=5          "
-    expected_header_v6 = b"reMarkable .lines file, version=6          "
-    if len(data) < len(expected_header_v5) + 4:
-        raise ValueError(f"{file_path} is too short to be a valid .rm file")
+@dataclass
+class ParsedPage:
+    """A single .rm page, read and decoded once, then handed to everyone who needs it"""
 
-    offset = 0
-    fmt = f"<{len(expected_header_fmt)}sI"
+    path: pathlib.Path
 
-    header, nlayers = struct.unpack_from(fmt, data, offset)
+    version: str
+    """One of the `ReMarkableAnnotationsFileHeaderVersion` values"""
 
-    offset += struct.calcsize(fmt)
+    data: TLayers
+    has_highlighter: bool
 
-    is_v3 = header == expected_header_v3
-    is_v5 = header == expected_header_v5
-    is_v6 = header == expected_header_v6
+    dimensions: ReMarkableDimensions
+    """The bounds of the page, see `determine_document_dimensions`"""
+
+    tree: SceneTree | None = None
+    """v6 only, not available when the page was loaded from the parse cache"""
+
+    def scene_tree(self) -> SceneTree:
+        """The scene tree of a v6 page. Pages from the parse cache get it from the scenes cache, which only reads
+        the file again if it changed since it was parsed."""
+        if self.tree is None:
+            with open_rm_file(self.path) as (_, mm):
+                self.tree = read_scene_resuming(self.path, mm)
+        return self.tree
+
+    @property
+    def render_cost(self) -> int:
+        """How heavy the page is to draw as vectors: all of its points, plus a fixed cost for every stroke"""
+        return sum(
+            len(layer["strokes"]) * STROKE_RENDER_COST + len(layer["strokes"].points) for layer in self.data["layers"]
+        )
 
-    if is_v3 or is_v5:
-        return parse_v3_to_v5(data, dims, is_v3, nlayers, offset), "V5"
+    @property
+    def text(self) -> TTextBlock | None:
+        return self.data["text"]
 
-    if is_v6:
-        return parse_v6(file_path), "V6"
+    @property
+    def highlights(self) -> List[GlyphRange]:
+        return self.data["highlights"]
+
+
+def parse_page(file_path, dims=None) -> ParsedPage:
+    """Parse an .rm file, or load it from the parse cache when the exact same bytes have been parsed before"""
+    if dims is None:
+        dims = REMARKABLE_DOCUMENT
+
+    with open_rm_file(file_path) as (header, mm):
+        if mm is None:
+            raise ValueError(f"{file_path} is too short to be a valid .rm file")
+
+        cache = get_cache("pages", PARSED_PAGE_CACHE_VERSION)
+        if cache is not None:
+            key = cache.key(mm, dims.width, dims.height)
+            cached = cache.get(key)
+            if cached is not None:
+                return parsed_page_from_cache(file_path, *cached)
+
+        page = decode_page(file_path, header, mm, dims)
+
+        if cache is not None:
+            cache.put(key, *parsed_page_to_cache(page))
+        return page
+
+
+def decode_page(file_path, header: RmFileHeader, mm: mmap.mmap, dims: ReMarkableDimensions) -> ParsedPage:
+    if header.version in (ReMarkableAnnotationsFileHeaderVersion.V3, ReMarkableAnnotationsFileHeaderVersion.V5):
+        is_v3 = header.version == ReMarkableAnnotationsFileHeaderVersion.V3
+        layers, has_highlighter = parse_v3_to_v5(mm, dims, is_v3, header.nlayers, RM_HEADER.size)
+        return ParsedPage(
+            path=file_path,
+            version=header.version,
+            data=layers,
+            has_highlighter=has_highlighter,
+            dimensions=REMARKABLE_DOCUMENT,
+        )
+
+    if header.version == ReMarkableAnnotationsFileHeaderVersion.V6:
+        tree = read_scene_resuming(file_path, mm)
+        data = parse_v6_scene(tree)
+        return ParsedPage(
+            path=file_path,
+            version=header.version,
+            data=data,
+            has_highlighter=False,
+            dimensions=determine_strokes_dimensions(data["layers"][0]["strokes"]),
+            tree=tree,
+        )
 
     raise ValueError(
-        f"{file_path} is not a valid .rm file: <header={header}><nlayers={nlayers}>"
+        f"{file_path} is not a valid .rm file: <header={header.header}><nlayers={header.nlayers}>"
     )
 
 
-def parse_v3_to_v5(data, dims: ReMarkableDimensions, is_v3, nlayers, offset):
-    output: TLayers = {"layers": [], "highlights": [], "text": []}
-    has_highlighter = False
+# Bump this whenever the parsing output changes, so cached pages from older versions are thrown away
+PARSED_PAGE_CACHE_VERSION = 4
+
+STROKES_FIELDS = ("points", "offsets", "tools", "colors", "widths", "opacities", "bboxes")
+
+
+def parsed_page_to_cache(page: ParsedPage) -> Tuple[dict, Dict[str, np.ndarray]]:
+    """Splits a page into picklable metadata and the stroke arrays, which are stored as-is"""
+    arrays = {}
+    for i, layer in enumerate(page.data["layers"]):
+        for field in STROKES_FIELDS:
+            arrays[f"layer{i}-{field}"] = getattr(layer["strokes"], field)
+    meta = {
+        "version": page.version,
+        "has_highlighter": page.has_highlighter,
+        "dimensions": (page.dimensions.width, page.dimensions.height),
+        "rectangles": [layer["rectangles"] for layer in page.data["layers"]],
+        "highlights": page.data["highlights"],
+        "text": page.data["text"],
+    }
+    return meta, arrays
+
+
+def parsed_page_from_cache(file_path, meta: dict, arrays: Dict[str, np.ndarray]) -> ParsedPage:
+    layers: List[TLayer] = []
+    for i, rectangles in enumerate(meta["rectangles"]):
+        strokes = Strokes(**{field: arrays[f"layer{i}-{field}"] for field in STROKES_FIELDS})
+        layers.append({"strokes": strokes, "rectangles": rectangles})
+    return ParsedPage(
+        path=file_path,
+        version=meta["version"],
+        data={"layers": layers, "highlights": meta["highlights"], "text": meta["text"]},
+        has_highlighter=meta["has_highlighter"],
+        dimensions=ReMarkableDimensions(*meta["dimensions"]),
+    )
+
+
+# Every point in a v3/v5 stroke is six little-endian float32s
+V5_POINT_DTYPE = np.dtype(
+    [
+        ("x", "<f4"),
+        ("y", "<f4"),
+        ("pressure", "<f4"),
+        ("tilt", "<f4"),
+        ("unknown_1", "<f4"),
+        ("unknown_2", "<f4"),
+    ]
+)
+
+V3_STROKE_HEADER = struct.Struct("<IIIfI")
+V5_STROKE_HEADER = struct.Struct("<IIIffI")
+
+
+class TV5Stroke(TypedDict):
+    pen: int
+    color: int
+    width: float
+    points: np.ndarray
+
+
+def decode_v3_to_v5(data, is_v3, nlayers, offset) -> List[List[TV5Stroke]]:
+    """Walks only the layer and stroke headers of a v3/v5 file.
+
+    The points of each stroke are read as a structured `V5_POINT_DTYPE` array straight from `data`, without copying."""
+    layers = []
+    stroke_header = V3_STROKE_HEADER if is_v3 else V5_STROKE_HEADER
     for _ in range(nlayers):
         fmt = "<I"
         (nstrokes,) = struct.unpack_from(fmt, data, offset)
         offset += struct.calcsize(fmt)
 
-        new_layer: TLayer = {"strokes": {}, "rectangles": []}
-
+        strokes: List[TV5Stroke] = []
         for _ in range(nstrokes):
             if is_v3:
-                fmt = "<IIIfI"
                 # cc for color-code, w for stroke-width
-                pen, cc, _, w, nsegs = struct.unpack_from(fmt, data, offset)
-                offset += struct.calcsize(fmt)
+                pen, cc, _, w, nsegs = stroke_header.unpack_from(data, offset)
             else:
-                fmt = "<IIIffI"
-                pen, cc, _, w, _, nsegs = struct.unpack_from(fmt, data, offset)
-                offset += struct.calcsize(fmt)
-
-            opc = 1  # opacity
-
-            tool, stroke_width, opacity = process_tool(pen, dims, w, opc)
-
-            if "Highlighter" in tool:
-                has_highlighter = True
-
-            if tool not in new_layer["strokes"].keys():
-                new_layer["strokes"] = update_stroke_dict(new_layer["strokes"], tool)
-
-            sg = create_seg_dict(opacity, stroke_width, cc)
-            p = []
+                pen, cc, _, w, _, nsegs = stroke_header.unpack_from(data, offset)
+            offset += stroke_header.size
 
-            for _ in range(nsegs):
-                fmt = "<ffffff"
-                x, y, press, tilt, _, _ = struct.unpack_from(fmt, data, offset)
-                offset += struct.calcsize(fmt)
+            points = np.frombuffer(data, dtype=V5_POINT_DTYPE, count=nsegs, offset=offset)
+            offset += points.nbytes
 
-                xpos, ypos = adjust_xypos_sizes(x, y, dims)
-                p.append((f"{xpos:.3f}", f"{ypos:.3f}"))
+            strokes.append({"pen": pen, "color": cc, "width": w, "points": points})
+        layers.append(strokes)
+    return layers
 
-            sg["points"].append(p)
-            new_layer["strokes"][tool]["segments"].append(sg)
 
-        output["layers"].append(new_layer)
+def parse_v3_to_v5(data, dims: ReMarkableDimensions, is_v3, nlayers, offset):
+    output: TLayers = {"layers": [], "highlights": [], "text": []}
+    has_highlighter = False
+    to_page = xypos_transform(dims)
+    decoded = decode_v3_to_v5(data, is_v3, nlayers, offset)
+    decoded_strokes = stroke = points = None
+    try:
+        for decoded_strokes in decoded:
+            strokes = StrokesBuilder()
+
+            for stroke in decoded_strokes:
+                opc = 1  # opacity
+
+                tool, stroke_width, opacity = process_tool(stroke["pen"], dims, stroke["width"], opc)
+
+                if "Highlighter" in tool:
+                    has_highlighter = True
+
+                points = stroke["points"]
+                strokes.add(
+                    stroke["pen"], stroke["color"], stroke_width, opacity, np.column_stack((points["x"], points["y"]))
+                )
+
+            layer_strokes = strokes.build()
+            layer_strokes.set_points(to_page.apply(layer_strokes.points))
+
+            output["layers"].append({"strokes": layer_strokes, "rectangles": []})
+    finally:
+        # The decoded points are views into `data`, which can't be closed while they are around, also not when
+        # they are kept alive by the frames of an exception
+        del decoded, decoded_strokes, stroke, points
     return output, has_highlighter
 
 
@@ -413,31 +939,24 @@ def parse_v3_to_v5(data, dims: ReMarkableDimensions, is_v3, nlayers, offset):
 def rescale_parsed_data(
     parsed_data: TLayers, scale: float, offset_x: int, offset_y: int
 ):
+    offset = AffineTransform.translate(offset_x, offset_y)
+    # Only the strokes are scaled, text and highlights are just moved
+    scaled_offset = offset @ AffineTransform.scale(scale)
+
     for layer in parsed_data["layers"]:
-        for _, st_value in layer["strokes"].items():
-            for _, sg_value in enumerate(st_value["segments"]):
-                sg_value["style"][
-                    "stroke-width"
-                ] = f"{float(sg_value['style']['stroke-width']):.3f}"
-
-                for i, points in enumerate(sg_value["points"]):
-                    for k, point in enumerate(points):
-                        sg_value["points"][i][k] = (
-                            f"{float(point[0]) * scale + offset_x:.3f}",
-                            f"{float(point[1]) * scale + offset_y:.3f}",
-                        )
+        strokes = layer["strokes"]
+        strokes.set_points(scaled_offset.apply(strokes.points))
 
     if "text" in parsed_data and parsed_data["text"]:
-        parsed_data["text"]["pos_x"] = parsed_data["text"]["pos_x"] + offset_x
-        parsed_data["text"]["pos_y"] = parsed_data["text"]["pos_y"] + offset_y
+        text = parsed_data["text"]
+        text["pos_x"], text["pos_y"] = offset.apply_xy(text["pos_x"], text["pos_y"])
 
-    for layer in parsed_data["layers"]:
-        for rmRectangles in layer["rectangles"]:
-            for geomRectangle in rmRectangles["rectangles"]:
-                geomRectangle.x = geomRectangle.x + offset_x
-                geomRectangle.y = geomRectangle.y + offset_y
-                # geomRectangle.w = geomRectangle.w
-                # geomRectangle.h = geomRectangle.h
+    offset.apply_rectangles([
+        geomRectangle
+        for layer in parsed_data["layers"]
+        for rmRectangles in layer["rectangles"]
+        for geomRectangle in rmRectangles["rectangles"]
+    ])
 
     return parsed_data
 
@@ -449,30 +968,24 @@ _line_segment_warning_has_been_shown = False
 
 def get_ann_max_bound(parsed_data):
     global _line_segment_warning_has_been_shown
-    # https://shapely.readthedocs.io/en/stable/manual.html#LineString
-    # https://shapely.readthedocs.io/en/stable/manual.html#MultiLineString
-    # https://shapely.readthedocs.io/en/stable/manual.html#object.bounds
-
-    collection = []
-
-    for strokes in parsed_data["layers"]:
-        for _, st_value in strokes["strokes"].items():
-            for _, sg_value in enumerate(st_value["segments"]):
-                for points in sg_value["points"]:
-                    if len(points) <= 1:
-                        # line needs at least two points, see testcase v2_notebook_complex
-                        if not _line_segment_warning_has_been_shown:
-                            logging.warning(
-                                "- Found a segment with a single point, will ignore it. Please report this "
-                                "issue at: https://github.com/lucasrla/remarks/issues/64 "
-                            )
-                            _line_segment_warning_has_been_shown = True
-                        continue
-                    line = geom.LineString([(float(p[0]), float(p[1])) for p in points])
-                    collection.append(line)
-
-    if len(collection) > 0:
-        (minx, miny, maxx, maxy) = geom.MultiLineString(collection).bounds
-        return (maxx, maxy, minx, miny)
+
+    x_max, y_max, x_min, y_min = -math.inf, -math.inf, math.inf, math.inf
+
+    for layer in parsed_data["layers"]:
+        strokes = layer["strokes"]
+        if not _line_segment_warning_has_been_shown and np.any(strokes.point_counts() <= 1):
+            # line needs at least two points, see testcase v2_notebook_complex
+            logging.warning(
+                "- Found a segment with a single point, will ignore it. Please report this "
+                "issue at: https://github.com/lucasrla/remarks/issues/64 "
+            )
+            _line_segment_warning_has_been_shown = True
+        bounds = strokes.bounds(min_points=2)
+        if bounds is not None:
+            x_min, y_min = min(x_min, bounds[0]), min(y_min, bounds[1])
+            x_max, y_max = max(x_max, bounds[2]), max(y_max, bounds[3])
+
+    if math.isfinite(x_min):
+        return (x_max, y_max, x_min, y_min)
     else:
         return (0, 0, 0, 0)
@@ -0,0 +1,103 @@
+import logging
+from dataclasses import dataclass
+
+import numpy as np
+from rmc.exporters.svg import SCALE
+from rmscene.scene_items import Line
+
+from .parsing import ParsedPage, PointArray, Strokes
+from ..metadata import ReMarkableAnnotationsFileHeaderVersion
+
+
+@dataclass
+class SimplificationReport:
+    tolerance: float
+    """In typographic points, like the output PDF"""
+
+    points_before: int = 0
+    points_after: int = 0
+
+    def add(self, other: "SimplificationReport") -> None:
+        self.points_before += other.points_before
+        self.points_after += other.points_after
+
+    @property
+    def reduction(self) -> float:
+        if self.points_before == 0:
+            return 0.0
+        return 1 - self.points_after / self.points_before
+
+    def log(self, subject: str) -> None:
+        logging.info(
+            f"- Simplified {subject} with a tolerance of {self.tolerance}pt: "
+            f"{self.points_before} -> {self.points_after} points ({self.reduction:.1%} fewer)"
+        )
+
+
+def ramer_douglas_peucker(points: np.ndarray, tolerance: float) -> np.ndarray:
+    """Mask of the points to keep, so that no dropped point lies further than `tolerance` from the
+    simplified line. The first and last point are always kept."""
+    n = len(points)
+    keep = np.zeros(n, dtype=bool)
+    keep[[0, -1]] = True
+    if n <= 2:
+        keep[:] = True
+        return keep
+    points = points.astype(np.float64)
+
+    # Iterative instead of recursive, long strokes would hit the recursion limit
+    stack = [(0, n - 1)]
+    while stack:
+        first, last = stack.pop()
+        if last - first < 2:
+            continue
+        dx, dy = points[last] - points[first]
+        rel = points[first + 1:last] - points[first]
+        length = np.hypot(dx, dy)
+        if length == 0:
+            # Closed stroke, fall back to the distance to the start
+            distances = np.hypot(rel[:, 0], rel[:, 1])
+        else:
+            distances = np.abs(dx * rel[:, 1] - dy * rel[:, 0]) / length
+        furthest = int(np.argmax(distances))
+        if distances[furthest] > tolerance:
+            split = first + 1 + furthest
+            keep[split] = True
+            stack.append((first, split))
+            stack.append((split, last))
+    return keep
+
+
+def simplification_mask(strokes: Strokes, tolerance: float) -> np.ndarray:
+    """`ramer_douglas_peucker` applied to every stroke, as one mask over `strokes.points`"""
+    keep = np.ones(len(strokes.points), dtype=bool)
+    for i in np.flatnonzero(strokes.point_counts() > 2):
+        start, end = strokes.offsets[i], strokes.offsets[i + 1]
+        keep[start:end] = ramer_douglas_peucker(strokes.points[start:end], tolerance)
+    return keep
+
+
+def simplify_page(page: ParsedPage, tolerance: float) -> SimplificationReport:
+    """Simplify the strokes of a parsed page in place, `tolerance` is in typographic points.
+
+    For v6 pages the lines of the scene tree are simplified too, since that is what gets rendered."""
+    report = SimplificationReport(tolerance)
+    # Strokes are in reMarkable units, rmc renders them at SCALE points per unit
+    rm_tolerance = tolerance / SCALE
+
+    for layer in page.data["layers"]:
+        strokes: Strokes = layer["strokes"]
+        keep = simplification_mask(strokes, rm_tolerance)
+        report.points_before += len(keep)
+        report.points_after += int(keep.sum())
+        layer["strokes"] = strokes.keep_points(keep)
+
+        if page.version == ReMarkableAnnotationsFileHeaderVersion.V6:
+            # The strokes of a v6 page are the lines of its tree, in walking order
+            lines = (el for el in page.scene_tree().walk() if isinstance(el, Line))
+            for line, start, end in zip(lines, strokes.offsets[:-1], strokes.offsets[1:]):
+                if isinstance(line.points, PointArray):
+                    line.points = line.points[keep[start:end]]
+                else:
+                    line.points = [p for p, kept in zip(line.points, keep[start:end]) if kept]
+    return report
@@ -0,0 +1,93 @@
+import math
+from typing import Tuple
+
+import numpy as np
+
+# Strokes covering more cells than this (long diagonal lines, huge scribbles, ...) are not put in the grid,
+# they are checked on every query instead. This keeps the index small for pathological pages.
+MAX_CELLS_PER_STROKE = 64
+
+
+class StrokeIndex:
+    """A uniform grid over the per-stroke bounding boxes of a `Strokes`, answering rectangle queries.
+
+    Used to find the strokes an eraser passes over, without checking every stroke of the layer."""
+
+    def __init__(self, bboxes: np.ndarray, cell_size: float | None = None):
+        self.bboxes = bboxes
+        has_points = ~np.isnan(bboxes).any(axis=1)
+        indices = np.flatnonzero(has_points)
+
+        if len(indices) == 0:
+            self.origin = (0.0, 0.0)
+            self.cell_size = 1.0
+            self.shape = (1, 1)
+            self._cell_starts = np.zeros(2, dtype=np.int64)
+            self._cell_strokes = np.empty(0, dtype=np.int64)
+            self._oversized = np.empty(0, dtype=np.int64)
+            return
+
+        boxes = bboxes[indices].astype(np.float64)
+        x_min, y_min = boxes[:, :2].min(axis=0)
+        x_max, y_max = boxes[:, 2:].max(axis=0)
+        if cell_size is None:
+            # Aim for roughly one stroke per cell
+            cell_size = max(x_max - x_min, y_max - y_min, 1.0) / math.ceil(math.sqrt(len(indices)))
+        self.origin = (float(x_min), float(y_min))
+        self.cell_size = float(cell_size)
+        nx = int((x_max - x_min) // cell_size) + 1
+        ny = int((y_max - y_min) // cell_size) + 1
+        self.shape = (nx, ny)
+
+        cx0, cy0, cx1, cy1 = self._cells(boxes)
+        span_x = cx1 - cx0 + 1
+        span_y = cy1 - cy0 + 1
+        n_cells = span_x * span_y
+
+        oversized = n_cells > MAX_CELLS_PER_STROKE
+        self._oversized = indices[oversized]
+
+        keep = ~oversized
+        indices, cx0, cy0, span_x, n_cells = indices[keep], cx0[keep], cy0[keep], span_x[keep], n_cells[keep]
+
+        # Expand every stroke into the cells it covers
+        stroke_ids = np.repeat(indices, n_cells)
+        first = np.repeat(np.cumsum(n_cells) - n_cells, n_cells)
+        local = np.arange(len(stroke_ids)) - first
+        span_x = np.repeat(span_x, n_cells)
+        cell_x = np.repeat(cx0, n_cells) + local % span_x
+        cell_y = np.repeat(cy0, n_cells) + local // span_x
+        cell_ids = cell_y * nx + cell_x
+
+        order = np.argsort(cell_ids, kind="stable")
+        self._cell_strokes = stroke_ids[order]
+        self._cell_starts = np.searchsorted(cell_ids[order], np.arange(nx * ny + 1))
+
+    def _cells(self, boxes: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+        nx, ny = self.shape
+        x, y = self.origin
+        cx0 = np.clip(np.floor((boxes[:, 0] - x) / self.cell_size), 0, nx - 1).astype(np.int64)
+        cy0 = np.clip(np.floor((boxes[:, 1] - y) / self.cell_size), 0, ny - 1).astype(np.int64)
+        cx1 = np.clip(np.floor((boxes[:, 2] - x) / self.cell_size), 0, nx - 1).astype(np.int64)
+        cy1 = np.clip(np.floor((boxes[:, 3] - y) / self.cell_size), 0, ny - 1).astype(np.int64)
+        return cx0, cy0, cx1, cy1
+
+    def query(self, x_min: float, y_min: float, x_max: float, y_max: float) -> np.ndarray:
+        """Indices of all strokes whose bounding box intersects the rectangle, in drawing order"""
+        (cx0,), (cy0,), (cx1,), (cy1,) = self._cells(np.array([[x_min, y_min, x_max, y_max]], dtype=np.float64))
+        nx, _ = self.shape
+
+        rows = [
+            self._cell_strokes[self._cell_starts[cy * nx + cx0]:self._cell_starts[cy * nx + cx1 + 1]]
+            for cy in range(cy0, cy1 + 1)
+        ]
+        candidates = np.unique(np.concatenate(rows + [self._oversized]))
+
+        boxes = self.bboxes[candidates]
+        hits = (
+            (boxes[:, 0] <= x_max)
+            & (boxes[:, 2] >= x_min)
+            & (boxes[:, 1] <= y_max)
+            & (boxes[:, 3] >= y_min)
+        )
+        return candidates[hits]
@@ -1,6 +1,10 @@
+import math
 from dataclasses import dataclass
 from enum import Enum
 from fractions import Fraction
+from typing import List, Tuple
+
+import numpy as np
 
 
 class LengthUnit(Enum):
@@ -11,6 +15,69 @@ class LengthUnit(Enum):
     pt = "Typographic point"
 
 
+class AffineTransform:
+    """A 2D affine transformation, stored as a 3x3 matrix acting on (x, y, 1) column vectors.
+
+    Transforms compose with `@`: `(b @ a)` first applies `a`, then `b`. They work on single coordinates
+    as well as on whole (n, 2) coordinate arrays in one go."""
+
+    def __init__(self, matrix):
+        self.matrix = np.asarray(matrix, dtype=np.float64)
+
+    @classmethod
+    def identity(cls) -> "AffineTransform":
+        return cls(np.eye(3))
+
+    @classmethod
+    def scale(cls, sx: float, sy: float | None = None) -> "AffineTransform":
+        return cls([[sx, 0, 0], [0, sx if sy is None else sy, 0], [0, 0, 1]])
+
+    @classmethod
+    def translate(cls, tx: float, ty: float) -> "AffineTransform":
+        return cls([[1, 0, tx], [0, 1, ty], [0, 0, 1]])
+
+    def __matmul__(self, other: "AffineTransform") -> "AffineTransform":
+        return AffineTransform(self.matrix @ other.matrix)
+
+    def __repr__(self) -> str:
+        return f"AffineTransform({self.matrix[:2].tolist()})"
+
+    def inverse(self) -> "AffineTransform":
+        return AffineTransform(np.linalg.inv(self.matrix))
+
+    def apply(self, points: np.ndarray) -> np.ndarray:
+        """Transform an (n, 2) array of x/y coordinates, keeping its dtype"""
+        points = np.asarray(points)
+        result = points @ self.matrix[:2, :2].T + self.matrix[:2, 2]
+        return result.astype(points.dtype, copy=False) if np.issubdtype(points.dtype, np.floating) else result
+
+    def apply_xy(self, x, y):
+        """Transform x and y given separately, as numbers or arrays"""
+        (a, b, c), (d, e, f) = self.matrix[:2].tolist()
+        return a * x + b * y + c, d * x + e * y + f
+
+    def apply_size(self, width, height):
+        """Transform a width and height, which are not affected by translation"""
+        (a, b, _), (d, e, _) = self.matrix[:2].tolist()
+        return a * width + b * height, d * width + e * height
+
+    def apply_length(self, length):
+        """Scale a length that has no direction, like the width of a stroke, by the average scale of the transform"""
+        return length * math.sqrt(abs(np.linalg.det(self.matrix[:2, :2])))
+
+    def apply_rectangles(self, rectangles: List) -> None:
+        """Transform `rmscene.scene_items.Rectangle`s (e.g. of a GlyphRange) in place, in one vectorized call.
+
+        Only for transforms without rotation, so rectangles stay axis-aligned."""
+        if not rectangles:
+            return
+        xywh = np.array([(r.x, r.y, r.w, r.h) for r in rectangles], dtype=np.float64)
+        xywh[:, :2] = self.apply(xywh[:, :2])
+        xywh[:, 2:] = xywh[:, 2:] * np.diag(self.matrix)[:2]
+        for rectangle, (x, y, w, h) in zip(rectangles, xywh.tolist()):
+            rectangle.x, rectangle.y, rectangle.w, rectangle.h = x, y, w, h
+
+
 @dataclass
 class Dimensions:
     width: int
@@ -32,7 +99,7 @@ class ReMarkableDimensions(Dimensions):
     unit: LengthUnit = LengthUnit.rmpts
 
     def to_mm(self):
-        return PaperDimensions(int(self.width * (2100/1404)), int(self.height * (2970 / 1872)))
+        return PaperDimensions(*map(int, RM_TO_MM.apply_size(self.width, self.height)))
 
 
 @dataclass
@@ -41,7 +108,7 @@ class PaperDimensions(Dimensions):
     unit: LengthUnit = LengthUnit.mm
 
     def to_mu(self):
-        return PyMuPDFDimensions(int(self.width * (210 / 595)), int(self.height * (210 / 595)))
+        return PyMuPDFDimensions(*map(int, MM_TO_MU.apply_size(self.width, self.height)))
 
 
 @dataclass
@@ -50,7 +117,7 @@ class TypographicDimensions(Dimensions):
     unit: LengthUnit = LengthUnit.mm
 
     def to_mu(self):
-        return PyMuPDFDimensions(int(self.width * (210 / 595)), int(self.height * (210 / 595)))
+        return PyMuPDFDimensions(*map(int, PT_TO_MU.apply_size(self.width, self.height)))
 
 
 @dataclass
@@ -59,7 +126,7 @@ class PyMuPDFDimensions(Dimensions):
     unit: LengthUnit = LengthUnit.mupts
 
     def to_mm(self):
-        return PaperDimensions(int(self.width * (210 / 595)), int(self.height * (210 / 595)))
+        return PaperDimensions(*map(int, MU_TO_MM.apply_size(self.width, self.height)))
 
 
 # PyMuPDF's A4 default is width=595, height=842
@@ -71,3 +138,44 @@ REMARKABLE_DOCUMENT = ReMarkableDimensions(width=1404, height=1872)
 mu_a4 = PyMuPDFDimensions(width=595, height=842)
 
 REMARKABLE_PDF_EXPORT = TypographicDimensions(width=445, height=594)
+
+# Conversions between the units of `LengthUnit`. These are the factors remarks has always used to size pages,
+# the output PDFs depend on them.
+RM_TO_MM = AffineTransform.scale(2100 / 1404, 2970 / 1872)
+MM_TO_MU = AffineTransform.scale(210 / 595)
+MU_TO_MM = AffineTransform.scale(210 / 595)
+PT_TO_MU = AffineTransform.scale(210 / 595)
+RM_TO_MU = MM_TO_MU @ RM_TO_MM
+
+# How rmc scales reMarkable points to typographic points when rendering
+RM_TO_PT = AffineTransform.scale(72 / 226)
+
+
+def place_on_background(
+    background_size: Tuple[float, float], view_box: Tuple[float, float, float, float]
+) -> Tuple[Tuple[float, float], Tuple[float, float, float, float], Tuple[float, float, float, float]]:
+    """Where to put a rendered annotations page (with its SVG `view_box`: x, y, width, height) and the background
+    page it annotates, so that the top middle of the background lines up with (0, 0) of the annotations.
+
+    Returns the size of a page that fits both, and the rectangles (x0, y0, x1, y1) of the background and of the
+    annotations on it."""
+    w_bg, h_bg = background_size
+    x_shift, y_shift, w_svg, h_svg = view_box
+
+    width, height = max(w_svg, w_bg), max(h_svg, h_bg)
+    x_svg, y_svg = 0, 0
+    x_bg, y_bg = 0, 0
+    if w_svg > w_bg:
+        x_bg = width / 2 - w_bg / 2 - (w_svg / 2 + x_shift)
+    elif w_svg < w_bg:
+        x_svg = width / 2 - w_svg / 2 + (w_svg / 2 + x_shift)
+    if h_svg > h_bg:
+        y_bg = - y_shift
+    elif h_svg < h_bg:
+        y_svg = y_shift
+
+    return (
+        (width, height),
+        (x_bg, y_bg, x_bg + w_bg, y_bg + h_bg),
+        (x_svg, y_svg, x_svg + w_svg, y_svg + h_svg),
+    )
@@ -0,0 +1,215 @@
+import logging
+import os
+import queue
+import selectors
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+from typing import Optional
+
+from .watchdog import restore_address_space
+
+INKSCAPE_EXECUTABLES = [
+    "inkscape",
+    # Default macOS location, which is usually not on the PATH
+    "/Applications/Inkscape.app/Contents/MacOS/inkscape",
+]
+
+# Inkscape can crash when several instances run in parallel, unless this is set
+# https://gitlab.com/inkscape/inkscape/-/issues/4716#note_1898150983
+INKSCAPE_ENV = {"SELF_CALL": "1"}
+
+# Inkscape isn't held to the memory budget of the page worker that starts it
+INKSCAPE_PREEXEC = restore_address_space if os.name == "posix" else None
+
+DEFAULT_WORKERS = min(4, os.cpu_count() or 1)
+
+# Seconds to wait for a worker to start, and for a single page to be converted
+STARTUP_TIMEOUT = 60
+CONVERSION_TIMEOUT = 120
+
+# What Inkscape prints in shell mode when it is ready for the next command
+SHELL_PROMPT = b"> "
+
+# Shell mode only works on files. On Linux /dev/shm is in memory, which keeps the pages off the disk like the
+# pipes of `--pipe` do. Elsewhere they go through the temporary directory, which costs a write and a read of every
+# SVG and PDF, but saves starting Inkscape for every page.
+SCRATCH_ROOT = "/dev/shm" if os.path.isdir("/dev/shm") and os.access("/dev/shm", os.W_OK | os.X_OK) else None
+
+_pool: Optional["InkscapePool"] = None
+
+
+class InkscapeError(Exception):
+    pass
+
+
+def find_inkscape() -> str:
+    for executable in INKSCAPE_EXECUTABLES:
+        path = shutil.which(executable)
+        if path is not None:
+            return path
+    raise FileNotFoundError(f"Inkscape not found, tried: {', '.join(INKSCAPE_EXECUTABLES)}")
+
+
+class InkscapeWorker:
+    """A long-lived `inkscape --shell` process, converting one SVG at a time.
+
+    Shell mode only works on files, so every worker gets a scratch directory of its own, in `SCRATCH_ROOT`."""
+
+    def __init__(self, executable: str):
+        self.scratch_dir = tempfile.mkdtemp(prefix="remarks-inkscape-", dir=SCRATCH_ROOT)
+        self.process = subprocess.Popen(
+            [executable, "--shell"],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            env={**os.environ, **INKSCAPE_ENV},
+            preexec_fn=INKSCAPE_PREEXEC,
+        )
+        try:
+            self._wait_for_prompt(STARTUP_TIMEOUT)
+        except Exception:
+            self.close()
+            raise
+
+    def is_alive(self) -> bool:
+        return self.process.poll() is None
+
+    def convert(self, svg: str) -> bytes:
+        svg_path = os.path.join(self.scratch_dir, "page.svg")
+        pdf_path = os.path.join(self.scratch_dir, "page.pdf")
+        with open(svg_path, "w", encoding="utf-8") as f:
+            f.write(svg)
+        if os.path.exists(pdf_path):
+            os.remove(pdf_path)
+
+        self._send(f"file-open:{svg_path};export-filename:{pdf_path};export-do;file-close")
+        self._wait_for_prompt(CONVERSION_TIMEOUT)
+
+        if not os.path.exists(pdf_path) or os.path.getsize(pdf_path) == 0:
+            raise InkscapeError("Inkscape did not export a PDF")
+        with open(pdf_path, "rb") as f:
+            return f.read()
+
+    def close(self):
+        if self.is_alive():
+            try:
+                self._send("quit")
+                self.process.wait(timeout=5)
+            except (OSError, subprocess.TimeoutExpired):
+                self.process.kill()
+                self.process.wait()
+        shutil.rmtree(self.scratch_dir, ignore_errors=True)
+
+    def _send(self, command: str):
+        try:
+            self.process.stdin.write(f"{command}\n".encode("utf-8"))
+            self.process.stdin.flush()
+        except OSError as e:
+            raise InkscapeError(f"Inkscape stopped accepting commands: {e}") from e
+
+    def _wait_for_prompt(self, timeout: float):
+        """Read the output of the last command, until Inkscape asks for the next one"""
+        output = b""
+        deadline = time.monotonic() + timeout
+        with selectors.DefaultSelector() as selector:
+            selector.register(self.process.stdout, selectors.EVENT_READ)
+            while not output.endswith(SHELL_PROMPT):
+                remaining = deadline - time.monotonic()
+                if remaining <= 0 or not selector.select(remaining):
+                    raise InkscapeError(f"Inkscape did not respond within {timeout} seconds")
+                chunk = os.read(self.process.stdout.fileno(), 4096)
+                if not chunk:
+                    raise InkscapeError(f"Inkscape exited with code {self.process.wait()}")
+                output += chunk
+
+
+class InkscapePool:
+    """At most `size` Inkscape workers, started on first use and kept warm between pages.
+
+    Workers that died in the meantime are replaced before use, and a conversion that fails is retried once on a
+    fresh worker, so a crash of Inkscape costs a restart rather than the page."""
+
+    def __init__(self, size: int = DEFAULT_WORKERS, executable: Optional[str] = None):
+        self.size = size
+        self.executable = executable
+        self._slots = threading.BoundedSemaphore(size)
+        self._idle: "queue.LifoQueue[InkscapeWorker]" = queue.LifoQueue()
+
+    def svg_to_pdf(self, svg: str) -> bytes:
+        with self._slots:
+            worker = self._take_worker()
+            try:
+                try:
+                    pdf = worker.convert(svg)
+                except InkscapeError as e:
+                    logging.warning(f"- Restarting Inkscape: {e}")
+                    worker.close()
+                    worker = self._new_worker()
+                    pdf = worker.convert(svg)
+            except BaseException:
+                worker.close()
+                raise
+            self._idle.put(worker)
+            return pdf
+
+    def close(self):
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                return
+
+    def _take_worker(self) -> InkscapeWorker:
+        """An idle worker that is still running, or a new one"""
+        while True:
+            try:
+                worker = self._idle.get_nowait()
+            except queue.Empty:
+                return self._new_worker()
+            if worker.is_alive():
+                return worker
+            logging.warning(f"- Inkscape exited with code {worker.process.returncode}, starting a new one")
+            worker.close()
+
+    def _new_worker(self) -> InkscapeWorker:
+        if self.executable is None:
+            self.executable = find_inkscape()
+        return InkscapeWorker(self.executable)
+
+
+def configure_inkscape_pool(size: int = DEFAULT_WORKERS) -> None:
+    """Convert SVGs with a pool of `size` Inkscape workers, pass 0 to start Inkscape for every SVG instead"""
+    global _pool
+    if _pool is not None:
+        _pool.close()
+    _pool = InkscapePool(size) if size > 0 else None
+
+
+def svg_to_pdf(svg: str) -> bytes:
+    """Convert an SVG document to PDF with Inkscape, on the worker pool if there is one, otherwise with a new
+    Inkscape process that the SVG is piped through"""
+    if _pool is not None:
+        return _pool.svg_to_pdf(svg)
+
+    result = subprocess.run(
+        [find_inkscape(), "--pipe", "--export-type=pdf", "--export-filename=-"],
+        input=svg.encode("utf-8"),
+        capture_output=True,
+        check=True,
+        env={**os.environ, **INKSCAPE_ENV},
+        preexec_fn=INKSCAPE_PREEXEC,
+    )
+    return result.stdout
+
+
+def _forget_pool_after_fork():
+    """Forked processes would share the pipes of the Inkscape workers of their parent, so they start without a
+    pool. Those that convert many SVGs configure one of their own, and close it before they exit."""
+    global _pool
+    _pool = None
+
+
+os.register_at_fork(after_in_child=_forget_pool_after_fork)
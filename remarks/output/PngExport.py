@@ -0,0 +1,105 @@
+import math
+import pathlib
+from concurrent.futures import ProcessPoolExecutor
+from typing import Iterator, List, Optional, Tuple
+
+import fitz  # PyMuPDF
+
+# Pages larger than this many pixels on either side are rendered in tiles of at most this size
+MAX_TILE_SIZE = 4096
+
+# The output PDF, opened once in every worker process
+_worker_pdf: Optional[fitz.Document] = None
+# The page the last tile was cut from in the worker process, along with its display list
+_worker_display_list: Optional[Tuple[int, fitz.DisplayList]] = None
+
+# (page index, row, column, clip rectangle or None for the whole page, output file)
+Tile = Tuple[int, int, int, Optional[Tuple[float, float, float, float]], str]
+
+
+class PngExport:
+    """PNG images of pages of the output PDF, rasterized with `Page.get_pixmap`.
+
+    Pages that would be larger than `MAX_TILE_SIZE` pixels are split into tiles, which end up in files of their
+    own, so no page ever needs one huge pixmap. The content of a page is interpreted once into a display list,
+    which every tile of the page is rendered from. Only what overlaps a tile is drawn into it, rather than the
+    whole page being interpreted and drawn again for every tile."""
+
+    def __init__(self, pdf_path: str, dpi: int, max_tile_size: int = MAX_TILE_SIZE):
+        self.pdf_path = pdf_path
+        self.dpi = dpi
+        self.max_tile_size = max_tile_size
+
+    def save(self, location: str, pages: List[int], jobs: int = 1) -> List[str]:
+        """Write the PNGs of `pages` (indices in the PDF) into the "`location` _remarks" directory, using `jobs`
+        processes. Returns the paths written."""
+        out_dir = pathlib.Path(f"{location} _remarks")
+        out_dir.mkdir(parents=True, exist_ok=True)
+
+        with fitz.open(self.pdf_path) as pdf:
+            tiles = [tile for page_idx in pages for tile in self.tiles(pdf[page_idx], page_idx, out_dir)]
+
+        if jobs > 1 and len(tiles) > 1:
+            with ProcessPoolExecutor(jobs, initializer=_open_worker_pdf, initargs=(self.pdf_path,)) as executor:
+                return list(executor.map(_render_tile, tiles, [self.dpi] * len(tiles)))
+
+        _open_worker_pdf(self.pdf_path)
+        try:
+            return [_render_tile(tile, self.dpi) for tile in tiles]
+        finally:
+            _close_worker_pdf()
+
+    def tiles(self, page: fitz.Page, page_idx: int, out_dir: pathlib.Path) -> Iterator[Tile]:
+        # Points to pixels
+        zoom = self.dpi / 72
+        width, height = page.rect.width * zoom, page.rect.height * zoom
+        name = f"page-{page_idx + 1:03}"
+
+        if width <= self.max_tile_size and height <= self.max_tile_size:
+            yield page_idx, 0, 0, None, str(out_dir / f"{name}.png")
+            return
+
+        tile_size = self.max_tile_size / zoom
+        rows = math.ceil(page.rect.height / tile_size)
+        columns = math.ceil(page.rect.width / tile_size)
+        for row in range(rows):
+            for column in range(columns):
+                clip = fitz.Rect(
+                    page.rect.x0 + column * tile_size,
+                    page.rect.y0 + row * tile_size,
+                    min(page.rect.x0 + (column + 1) * tile_size, page.rect.x1),
+                    min(page.rect.y0 + (row + 1) * tile_size, page.rect.y1),
+                )
+                yield page_idx, row, column, tuple(clip), str(out_dir / f"{name}-{row + 1}-{column + 1}.png")
+
+
+def _open_worker_pdf(pdf_path: str):
+    global _worker_pdf
+    _worker_pdf = fitz.open(pdf_path)
+
+
+def _close_worker_pdf():
+    global _worker_pdf, _worker_display_list
+    _worker_display_list = None
+    _worker_pdf.close()
+    _worker_pdf = None
+
+
+def _display_list(page_idx: int) -> fitz.DisplayList:
+    """The display list of a page, kept while the tiles of that page are rendered"""
+    global _worker_display_list
+    if _worker_display_list is None or _worker_display_list[0] != page_idx:
+        _worker_display_list = (page_idx, _worker_pdf[page_idx].get_displaylist())
+    return _worker_display_list[1]
+
+
+def _render_tile(tile: Tile, dpi: int) -> str:
+    page_idx, _, _, clip, path = tile
+    # Like `Page.get_pixmap(dpi=dpi, clip=clip)`, which would interpret the whole page again
+    zoom = dpi / 72
+    pixmap = _display_list(page_idx).get_pixmap(
+        matrix=fitz.Matrix(zoom, zoom), colorspace=fitz.csRGB, clip=fitz.Rect(clip) if clip else None
+    )
+    pixmap.set_dpi(dpi, dpi)
+    pixmap.save(path)
+    return path
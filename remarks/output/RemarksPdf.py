@@ -0,0 +1,338 @@
+import hashlib
+import logging
+import os
+import re
+import time
+from dataclasses import dataclass
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+import fitz  # PyMuPDF
+from fitz import Page
+
+# The kinds of page resources that are shared when they are identical
+SHARED_RESOURCES = ("Font", "ExtGState", "XObject", "ColorSpace", "Pattern", "Shading")
+
+# "/Name 12 0 R" entries in a dictionary, and references in general
+NAMED_REFERENCE = re.compile(r"/([^\s/<>\[\]()]+)\s*(\d+)\s+0\s+R")
+REFERENCE = re.compile(r"(\d+)\s+0\s+R")
+# References back to the page or the parent of an object, which do not make it any different
+BACK_REFERENCE = re.compile(r"/(?:P|Parent)\s*\d+\s+0\s+R")
+
+# Metadata that is written to the output, rather than describing the file
+METADATA_KEYS = ("author", "producer", "creator", "title", "subject", "keywords", "creationDate", "modDate")
+
+# What a page takes over from the page it is replaced with
+PAGE_KEYS = (
+    "Contents", "Resources", "Group", "MediaBox", "CropBox", "TrimBox", "BleedBox", "ArtBox", "Rotate", "UserUnit"
+)
+
+
+@dataclass(frozen=True)
+class SaveProfile:
+    options: Dict[str, Any]
+    """Keyword arguments of `Document.save`"""
+
+    share_resources: bool = True
+    """Point identical fonts, forms and images to a single copy first"""
+
+    incremental: bool = False
+    """Append the pages that changed to an existing output, instead of writing it from scratch"""
+
+
+SAVE_PROFILES = {
+    # Unused duplicates dropped, nothing compressed
+    "default": SaveProfile({"garbage": 1}),
+    # Written as it is in memory, for batch jobs
+    "fast": SaveProfile({}, share_resources=False),
+    # As small as PyMuPDF gets it, for archiving
+    "compact": SaveProfile(
+        {"garbage": 4, "clean": True, "deflate": True, "deflate_images": True, "deflate_fonts": True}
+    ),
+    # Saved like "default" when there is no output to append to yet
+    "incremental": SaveProfile({"garbage": 1}, incremental=True),
+}
+
+
+class RemarksPdf:
+    """The output PDF, built on a copy of the source document.
+
+    Pages that are drawn on in place are drawn on in the copy. Replacement pages are built at the end of it, and
+    take the place of their source page when saving: the page object stays, with the content, resources and size
+    of its replacement. Links from other pages, named destinations, the outline and page labels all refer to the
+    page object, so they keep working, as does everything else the source has (form fields, metadata)."""
+
+    def __init__(self, source: fitz.Document):
+        self.source = source
+        self.doc = fitz.open("pdf", source.tobytes())
+        # Source page -> (page of `doc` it is replaced with, where the source page is shown on it)
+        self._replacements: Dict[int, Tuple[int, Optional[fitz.Matrix]]] = {}
+
+    def _replace(self, page_idx: int, background: Optional[fitz.Matrix]):
+        if page_idx in self._replacements:
+            raise ValueError(f"Page {page_idx} has been replaced already")
+        self._replacements[page_idx] = (self.doc.page_count - 1, background)
+
+    def page(self, page_idx: int) -> Page:
+        """Source page `page_idx` as it is in the output, to draw on in place"""
+        if page_idx in self._replacements:
+            return self.doc[self._replacements[page_idx][0]]
+        return self.doc[page_idx]
+
+    def new_page(self, page_idx: int, width: float, height: float, background: Optional[fitz.Rect] = None) -> Page:
+        """An empty page of the given size in place of source page `page_idx`, with the source page shown in
+        `background` if there is one, the way it is displayed. The annotations and links of the source page are
+        moved along with it. Without a background they are dropped, as there is nothing they could point at."""
+        page = self.doc.new_page(-1, width=width, height=height)
+        if background is None:
+            self._replace(page_idx, None)
+            return page
+
+        source_page = self.source[page_idx]
+        rotation = source_page.rotation
+        # show_pdf_page ignores the rotation of the source page, it is shown unrotated and rotated explicitly
+        source_page.set_rotation(0)
+        try:
+            page.show_pdf_page(background, self.source, page_idx, rotate=-rotation)
+            source_rect = source_page.rect * ~source_page.transformation_matrix
+        finally:
+            source_page.set_rotation(rotation)
+        self._replace(page_idx, shown_at(source_rect, background * ~page.transformation_matrix, -rotation))
+        return page
+
+    def replace_page(
+            self, page_idx: int, doc: fitz.Document, from_page: int = 0, background: Optional[fitz.Matrix] = None
+    ):
+        """Put page `from_page` of `doc` in place of source page `page_idx`. If the source page is shown on it,
+        `background` is where (as a transformation of PDF coordinates), to move its annotations and links along."""
+        self.doc.insert_pdf(doc, from_page=from_page, to_page=from_page)
+        self._replace(page_idx, background)
+
+    def save(self, location: str, profile: str = "default") -> Tuple[int, float]:
+        """Write the output PDF with one of the `SAVE_PROFILES`, returns the bytes written and the seconds it took"""
+        for page_idx, (replacement, background) in self._replacements.items():
+            if background is None and _references(self.doc, self.doc[page_idx].xref, "Annots"):
+                logging.info(f"- Page {page_idx + 1} is not shown on its replacement, dropping its annotations")
+            take_place(self.doc, page_idx, replacement, background)
+        if self._replacements:
+            self.doc.delete_pages(from_page=self.source.page_count, to_page=self.doc.page_count - 1)
+            self._replacements = {}
+
+        path = f"{location} _remarks.pdf"
+        save_profile = SAVE_PROFILES[profile]
+        start = time.perf_counter()
+        written = None
+        if save_profile.incremental and os.path.exists(path):
+            written = self._append_changed_pages(path)
+        if written is None:
+            if save_profile.share_resources:
+                share_identical_resources(self.doc)
+            self.doc.save(path, **save_profile.options)
+            written = os.path.getsize(path)
+        seconds = time.perf_counter() - start
+
+        logging.info(f"- Saved with the {profile} profile: {written} bytes in {seconds:.2f}s")
+        return written, seconds
+
+    def _append_changed_pages(self, path: str) -> Optional[int]:
+        """Replace the pages of the output at `path` that changed since it was written, in an incremental update.
+        Returns the bytes appended, or None if the output has to be written from scratch."""
+        with fitz.open(path) as previous:
+            if not previous.can_save_incrementally() or previous.page_count != self.doc.page_count:
+                logging.info("- The previous output can't be updated, writing it from scratch")
+                return None
+
+            size = os.path.getsize(path)
+            for page_idx in changed_pages(previous, self.doc):
+                # Links are only copied along when they point to a page that is copied too
+                previous.insert_pdf(self.doc, from_page=page_idx, to_page=page_idx, links=False)
+                take_place(previous, page_idx, previous.page_count - 1, None)
+                previous.delete_page(-1)
+                page = previous[page_idx]
+                for link in self.doc[page_idx].get_links():
+                    page.insert_link(link)
+
+            metadata = {key: self.doc.metadata[key] for key in METADATA_KEYS}
+            if {key: previous.metadata[key] for key in METADATA_KEYS} != metadata:
+                previous.set_metadata(metadata)
+            toc = self.doc.get_toc(simple=False)
+            if previous.get_toc(simple=False) != toc:
+                previous.set_toc(toc)
+
+            if previous.is_dirty:
+                previous.saveIncr()
+            return os.path.getsize(path) - size
+
+
+class PageFragment(RemarksPdf):
+    """A single page of the output PDF, rendered on its own so it can be sent elsewhere as PDF bytes, to be put in
+    with `replace_page(page_idx, fragment, background=fragment.background)`"""
+
+    def __init__(self, source: fitz.Document, page_idx: int):
+        self.source = source
+        self.doc = fitz.open()
+        self.page_idx = page_idx
+        self.background: Optional[fitz.Matrix] = None
+
+    def _replace(self, page_idx: int, background: Optional[fitz.Matrix]):
+        if page_idx != self.page_idx or self.doc.page_count > 1:
+            raise ValueError(f"A fragment of page {self.page_idx} can only replace that page, once")
+        self.background = background
+
+    def page(self, page_idx: int) -> Page:
+        if self.doc.page_count == 0:
+            # A copy to draw on, the source page keeps its own annotations and links
+            self.doc.insert_pdf(self.source, from_page=page_idx, to_page=page_idx, links=False, annots=False)
+            self._replace(page_idx, fitz.Identity)
+        return self.doc[0]
+
+    def tobytes(self) -> bytes:
+        self.page(self.page_idx)
+        return self.doc.tobytes()
+
+
+def shown_at(source: fitz.Rect, target: fitz.Rect, rotate: int = 0) -> fitz.Matrix:
+    """The transformation `Page.show_pdf_page` applies to show `source` in `target` rotated by `rotate` degrees,
+    both in PDF coordinates"""
+    source_center, target_center = (source.tl + source.br) / 2, (target.tl + target.br) / 2
+    matrix = fitz.Matrix(1, 0, 0, 1, -source_center.x, -source_center.y) * fitz.Matrix(rotate)
+    rotated = source * matrix
+    scale = min(target.width / rotated.width, target.height / rotated.height)
+    return matrix * fitz.Matrix(scale, scale) * fitz.Matrix(1, 0, 0, 1, target_center.x, target_center.y)
+
+
+def take_place(doc: fitz.Document, page_idx: int, replacement: int, background: Optional[fitz.Matrix]) -> None:
+    """Give page `page_idx` of `doc` the content, resources, geometry and annotations of page `replacement`, which
+    can be deleted afterwards. The page object itself stays, so everything that refers to it keeps working.
+
+    With a `background`, where the page is shown on its replacement, its own annotations are moved there and
+    kept. Otherwise they are dropped, along with its links."""
+    xref, replacement_xref = doc[page_idx].xref, doc[replacement].xref
+
+    annots = []
+    if background is not None:
+        for annot in _references(doc, xref, "Annots"):
+            kind, rect = doc.xref_get_key(annot, "Rect")
+            if kind == "array":
+                rect = fitz.Rect([float(value) for value in rect.strip("[]").split()]) * background
+                doc.xref_set_key(annot, "Rect", f"[{rect.x0:g} {rect.y0:g} {rect.x1:g} {rect.y1:g}]")
+            annots.append(annot)
+    for annot in _references(doc, replacement_xref, "Annots"):
+        doc.xref_set_key(annot, "P", f"{xref} 0 R")
+        annots.append(annot)
+
+    for key in PAGE_KEYS:
+        kind, value = doc.xref_get_key(replacement_xref, key)
+        if key == "Rotate" and kind == "null":
+            # Rather than a rotation inherited from the page tree
+            value = "0"
+        doc.xref_set_key(xref, key, value)
+    doc.xref_set_key(xref, "Annots", f"[{' '.join(f'{annot} 0 R' for annot in annots)}]" if annots else "null")
+
+
+def _references(doc: fitz.Document, xref: int, key: str) -> List[int]:
+    """The objects an array at `key` of object `xref` refers to"""
+    kind, value = doc.xref_get_key(xref, key)
+    if kind == "xref":
+        value = doc.xref_object(int(value.split()[0]), compressed=True)
+    elif kind != "array":
+        return []
+    return [int(ref) for ref in REFERENCE.findall(value)]
+
+
+def changed_pages(previous: fitz.Document, current: fitz.Document) -> List[int]:
+    """Indices of the pages of `current` that look different from the same page of `previous`"""
+    previous_keys, current_keys = ResourceSharing(previous), ResourceSharing(current)
+    return [
+        page_idx
+        for page_idx in range(current.page_count)
+        if previous_keys.key(previous[page_idx].xref) != current_keys.key(current[page_idx].xref)
+    ]
+
+
+def share_identical_resources(doc: fitz.Document) -> None:
+    """Make all pages refer to one copy of every distinct font, graphics state, form or image.
+
+    Every background page shown under annotations becomes a form XObject of its own, and every rendered
+    overlay comes with its own fonts and graphics states. Identical ones are found by their content, including
+    the content of everything they refer to, and references are pointed to the first one."""
+    ResourceSharing(doc).run()
+
+
+class ResourceSharing:
+    def __init__(self, doc: fitz.Document):
+        self.doc = doc
+        self._keys: Dict[int, str] = {}
+        self._canonical: Dict[str, int] = {}
+        self._visited_forms: Set[int] = set()
+
+    def run(self):
+        for page in self.doc:
+            self.share_resources(page.xref)
+
+    def share_resources(self, xref: int):
+        """Point the resources of object `xref` (a page or a form) to canonical objects"""
+        resources = self._dictionary(xref, "", "Resources")
+        if resources is None:
+            return
+        for category in SHARED_RESOURCES:
+            entries = self._dictionary(*resources, category)
+            if entries is None:
+                continue
+            entries_xref, entries_prefix = entries
+            if entries_prefix:
+                text = self.doc.xref_get_key(entries_xref, entries_prefix.rstrip("/"))[1]
+            else:
+                text = self.doc.xref_object(entries_xref, compressed=True)
+
+            for name, ref in NAMED_REFERENCE.findall(text):
+                ref = int(ref)
+                if category == "XObject" and ref not in self._visited_forms:
+                    # Forms have resources of their own, which are shared first
+                    self._visited_forms.add(ref)
+                    self.share_resources(ref)
+                canonical = self._canonical.setdefault(self.key(ref), ref)
+                if canonical != ref:
+                    self.doc.xref_set_key(entries_xref, f"{entries_prefix}{name}", f"{canonical} 0 R")
+
+        resources_xref, resources_prefix = resources
+        if not resources_prefix:
+            # The resources are an object of their own, which can be shared as a whole too
+            canonical = self._canonical.setdefault(self.key(resources_xref), resources_xref)
+            if canonical != resources_xref:
+                self.doc.xref_set_key(xref, "Resources", f"{canonical} 0 R")
+
+    def key(self, xref: int, visiting: Optional[Set[int]] = None) -> str:
+        """A hash of an object, its stream and everything it refers to"""
+        if xref in self._keys:
+            return self._keys[xref]
+        visiting = visiting or set()
+        if xref in visiting:
+            # A cycle, which makes the object unique
+            return f"xref {xref}"
+        visiting.add(xref)
+
+        keys = self.doc.xref_get_keys(xref)
+        if keys:
+            # Copying pages between documents reorders their entries
+            text = "".join(f"/{key} {self.doc.xref_get_key(xref, key)[1]}" for key in sorted(keys))
+        else:
+            text = self.doc.xref_object(xref, compressed=True)
+        text = BACK_REFERENCE.sub("", text)
+        digest = hashlib.blake2b(digest_size=20)
+        digest.update(REFERENCE.sub(lambda m: f"<{self.key(int(m[1]), visiting)}>", text).encode())
+        if self.doc.xref_is_stream(xref):
+            digest.update(self.doc.xref_stream_raw(xref))
+
+        visiting.discard(xref)
+        self._keys[xref] = digest.hexdigest()
+        return self._keys[xref]
+
+    def _dictionary(self, xref: int, prefix: str, key: str):
+        """Where the entries of dictionary `key` are, in the dictionary at `prefix` of object `xref`: as the
+        (xref, prefix) of an object of its own (with an empty prefix), or nested in the same object"""
+        kind, value = self.doc.xref_get_key(xref, f"{prefix}{key}")
+        if kind == "xref":
+            return int(value.split()[0]), ""
+        if kind == "dict":
+            return xref, f"{prefix}{key}/"
+        return None
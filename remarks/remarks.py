@@ -1,31 +1,43 @@
+import functools
+import importlib.metadata
+import itertools
 import logging
-import os
+import multiprocessing
 import pathlib
-import re
 import sys
 import tempfile
 import traceback
 import zipfile
 import copy
 
-from typing import List
+from typing import Any, Iterator, List, Optional, Tuple
 
 import fitz  # PyMuPDF
+import numpy as np
 from fitz import Page
-from rmc.exporters.pdf import svg_to_pdf
-from rmc.exporters.svg import rm_to_svg, PAGE_WIDTH_PT, PAGE_HEIGHT_PT
 from rmscene.scene_items import GlyphRange
 
 from .Document import Document
-from .conversion.parsing import (
-    parse_rm_file,
-    read_rm_file_version,
+from .dimensions import place_on_background
+from .inkscape import configure_inkscape_pool, svg_to_pdf, DEFAULT_WORKERS
+from .cache import configure_cache, get_cache, DEFAULT_CACHE_SIZE
+from .conversion.parsing import ParsedPage, open_rm_file
+from .conversion.drawing import (
+    render_pdf,
+    render_raster,
+    render_svg,
+    DEFAULT_PRECISION,
+    DEFAULT_RASTER_DPI,
+    DEFAULT_RASTER_THRESHOLD,
 )
+from .conversion.simplify import simplify_page, SimplificationReport
 from .conversion.text import (
     extract_groups_from_smart_hl,
 )
 from .metadata import ReMarkableAnnotationsFileHeaderVersion
 from .output.ObsidianMarkdownFile import ObsidianMarkdownFile
+from .output.PngExport import PngExport
+from .output.RemarksPdf import PageFragment, RemarksPdf
 from .utils import (
     is_document,
     get_document_filetype,
@@ -34,13 +46,35 @@ from .utils import (
     load_json_file,
 )
 from .warnings import scrybble_warning_only_v6_supported
-
-SVG_VIEWBOX_PATTERN = re.compile(r"^<svg .+ viewBox=\"([\-\d.]+) ([\-\d.]+) ([\-\d.]+) ([\-\d.]+)\">$")
-
+from .watchdog import RenderFailed, WatchdogPool
 
 def run_remarks(
-        input_dir, output_dir
+        input_dir, output_dir, cache_dir=None, cache_size=DEFAULT_CACHE_SIZE, simplify=None, renderer="rmc",
+        inkscape_workers=DEFAULT_WORKERS, jobs=1, png_dpi=None, save_profile="default", precision=DEFAULT_PRECISION,
+        raster_threshold=DEFAULT_RASTER_THRESHOLD, raster_dpi=DEFAULT_RASTER_DPI, page_timeout=None, page_memory=None,
 ):
+    if cache_dir is not None:
+        configure_cache(cache_dir, cache_size)
+    if renderer == "rmc":
+        configure_inkscape_pool(inkscape_workers)
+
+    # Pages are rendered on forked workers, which are kept for all documents
+    pool = None
+    if jobs > 1 or page_timeout is not None or page_memory is not None:
+        if "fork" in multiprocessing.get_all_start_methods():
+            pool = WatchdogPool(
+                jobs,
+                page_timeout,
+                page_memory * 1024 * 1024 if page_memory is not None else None,
+                # A worker renders one page at a time, which takes one Inkscape worker at most
+                initializer=functools.partial(configure_inkscape_pool, min(inkscape_workers, 1)),
+                finalizer=functools.partial(configure_inkscape_pool, 0),
+            )
+        else:
+            logging.warning(
+                "- Rendering pages one by one without time or memory budgets, which need processes to be forked"
+            )
+
     if input_dir.endswith(".rmn"):
         temp_dir = tempfile.mkdtemp()
         with zipfile.ZipFile(input_dir, 'r') as zip_ref:
@@ -78,12 +112,29 @@ def run_remarks(
             in_device_dir = get_ui_path(metadata_path)
             out_path = pathlib.Path(f"{output_dir}/{in_device_dir}/{doc_name}/")
 
-            process_document(metadata_path, out_path)
+            process_document(
+                metadata_path,
+                out_path,
+                simplify=simplify,
+                renderer=renderer,
+                jobs=jobs,
+                png_dpi=png_dpi,
+                save_profile=save_profile,
+                precision=precision,
+                raster_threshold=raster_threshold,
+                raster_dpi=raster_dpi,
+                pool=pool,
+            )
         else:
             logging.info(
                 f'\nFile skipped: "{doc_name}" ({metadata_path.stem}) due to unsupported filetype: {doc_type}. remarks only supports: {", ".join(supported_types)}'
             )
 
+    # Stop the page workers, and the Inkscape workers
+    if pool is not None:
+        pool.close()
+    configure_inkscape_pool(0)
+
     logging.info(
         f'\nDone processing "{input_dir}"',
     )
@@ -92,13 +143,38 @@ def run_remarks(
 def process_document(
         metadata_path,
         out_path,
+        simplify=None,
+        renderer="rmc",
+        jobs=1,
+        png_dpi=None,
+        save_profile="default",
+        precision=DEFAULT_PRECISION,
+        raster_threshold=DEFAULT_RASTER_THRESHOLD,
+        raster_dpi=DEFAULT_RASTER_DPI,
+        pool: Optional[WatchdogPool] = None,
 ):
+    """Write the annotated PDF of a document, and its markdown. With a `pool`, its pages are rendered on the
+    workers of the pool, otherwise here one by one."""
     document = Document(metadata_path)
-    rmc_pdf_src = document.open_source_pdf()
+    simplification = SimplificationReport(simplify) if simplify else None
+
+    pages = list(document.pages())
+    annotated = [(page_uuid, page_idx) for page_uuid, page_idx, _, has_annotations, _, _ in pages if has_annotations]
+    in_workers = pool is not None and len(annotated) > 0
+
+    # Pages rendered on the workers are parsed there, within their budgets
+    rmc_pdf_src = document.open_source_pdf(parse_pages=not in_workers)
+    output_pdf = RemarksPdf(rmc_pdf_src)
 
     obsidian_markdown = ObsidianMarkdownFile(document)
     obsidian_markdown.add_document_header()
 
+    rendered = None
+    if in_workers:
+        rendered = render_pages_in_parallel(
+            metadata_path, annotated, renderer, simplify, precision, raster_threshold, raster_dpi, pool
+        )
+
     for (
             page_uuid,
             page_idx,
@@ -106,101 +182,212 @@ def process_document(
             has_annotations,
             rm_highlights_file,
             has_smart_highlights,
-    ) in document.pages():
+    ) in pages:
         print(f"processing page {page_idx}, {page_uuid}")
-        page = rmc_pdf_src[page_idx]
-        rm_file_version = read_rm_file_version(rm_annotation_file)
-        (ann_data, has_ann_hl), version = parse_rm_file(rm_annotation_file)
-
-        if rm_file_version == ReMarkableAnnotationsFileHeaderVersion.V6:
-            temp_pdf = tempfile.NamedTemporaryFile(suffix=".pdf", mode="w", delete=False)
-            temp_svg = tempfile.NamedTemporaryFile(suffix=".svg", mode="w", delete=False)
-            try:
-                # convert the pdf
-                rm_to_svg(rm_annotation_file, temp_svg.name)
-                with open(temp_svg.name, "r") as svg_f, open(temp_pdf.name, "wb") as pdf_f:
-                    svg_to_pdf(svg_f, pdf_f)
-                svg_pdf = fitz.open(temp_pdf.name)
-
-                # if the background page is not empty, need to merge svg on top of background page
-                if page.get_contents() != []:
-                    w_bg, h_bg = page.cropbox.width, page.cropbox.height
-                    # find the (top, right) coordinates of the svg
-                    x_shift, y_shift, w_svg, h_svg = 0, 0, PAGE_WIDTH_PT, PAGE_HEIGHT_PT
-                    with open(temp_svg.name, "r") as f:
-                        svg_content = f.readlines()
-                    found = False
-                    for line in svg_content:
-                        res = SVG_VIEWBOX_PATTERN.match(line)
-                        if res is not None:
-                            x_shift, y_shift = float(res.group(1)), float(res.group(2))
-                            w_svg, h_svg = float(res.group(3)), float(res.group(4))
-                            found = True
-                            break
-                    if not found:
-                        logging.warning(f"Can't find x shift, y shift, width and height for {page_uuid}.")
-
-                    # compute the width/height of a blank page that can contains both svg and background pdf
-                    width, height = max(w_svg, w_bg), max(h_svg, h_bg)
-                    # compute position of svg and background in the new_page
-                    # it aligns the top-middle of the background and with the (0, 0) of the svg
-                    x_svg, y_svg = 0, 0
-                    x_bg, y_bg = 0, 0
-                    if w_svg > w_bg:
-                        x_bg = width / 2 - w_bg / 2 - (w_svg / 2 + x_shift)
-                    elif w_svg < w_bg:
-                        x_svg = width / 2 - w_svg / 2 + (w_svg / 2 + x_shift)
-                    if h_svg > h_bg:
-                        y_bg = - y_shift
-                    elif h_svg < h_bg:
-                        y_svg = y_shift
-
-                    # create the merged page in independent document as show_pdf_page can't be done on the same document
-                    doc = fitz.open()
-                    page = doc.new_page(-1,
-                                        width=width,
-                                        height=height)
-                    page.show_pdf_page(fitz.Rect(x_bg, y_bg, x_bg + w_bg, y_bg + h_bg),
-                                       rmc_pdf_src,
-                                       page_idx)
-                    page.show_pdf_page(fitz.Rect(x_svg, y_svg, x_svg + w_svg, y_svg + h_svg),
-                                       svg_pdf,
-                                       0)
-                    
-                    if ann_data and "highlights" in ann_data:
-                        apply_smart_highlights(page, ann_data["highlights"])
-                    rmc_pdf_src.insert_pdf(doc, start_at=page_idx)
-                else:
-                    rmc_pdf_src.insert_pdf(svg_pdf, start_at=page_idx)
-                rmc_pdf_src.delete_page(page_idx + 1)
-
-            except AttributeError:
-                add_error_annotation(page)
-            finally:
-                temp_pdf.close()
-                os.remove(temp_pdf.name)
-                temp_svg.close()
-                os.remove(temp_svg.name)
-        else:
-            scrybble_warning_only_v6_supported.render_as_annotation(page)
 
-        if ann_data:
-            if "text" in ann_data:
-                obsidian_markdown.add_text(page_idx, ann_data['text'])
-            if "highlights" in ann_data:
-                obsidian_markdown.add_highlights(page_idx, ann_data["highlights"])
+        if has_annotations:
+            if rendered is not None:
+                result = next(rendered)
+                if isinstance(result, RenderFailed):
+                    logging.error(f"- Page {page_idx + 1} could not be rendered: {result}")
+                    # The source page is kept as it is, with the error on it
+                    add_error_annotation(output_pdf.page(page_idx))
+                    text, highlights, report = None, [], None
+                else:
+                    (fragment, background), text, highlights, report = result
+                    output_pdf.replace_page(page_idx, fitz.open("pdf", fragment), background=background)
+            else:
+                parsed_page = document.take_parsed_page(page_uuid)
+                report = simplify_page(parsed_page, simplify) if simplify else None
+                render_page(
+                    output_pdf, page_idx, parsed_page, renderer, simplify, precision, raster_threshold, raster_dpi
+                )
+                text, highlights = parsed_page.text, parsed_page.highlights
+
+            if simplification and report:
+                simplification.add(report)
+            obsidian_markdown.add_text(page_idx, text)
+            obsidian_markdown.add_highlights(page_idx, highlights)
 
         if has_smart_highlights:
             smart_hl_data = load_json_file(rm_highlights_file)
             extract_groups_from_smart_hl(smart_hl_data)
 
+    if simplification:
+        simplification.log(f'"{document.name}"')
+
     out_doc_path_str = f"{out_path.parent}/{out_path.name}"
 
-    rmc_pdf_src.save(f"{out_doc_path_str} _remarks.pdf")
+    output_pdf.save(out_doc_path_str, save_profile)
+
+    if png_dpi:
+        png_export = PngExport(f"{out_doc_path_str} _remarks.pdf", png_dpi)
+        png_export.save(out_doc_path_str, [page_idx for _, page_idx in annotated], jobs)
 
     obsidian_markdown.save(out_doc_path_str)
 
 
+def render_page(
+        output_pdf,
+        page_idx: int,
+        parsed_page: ParsedPage,
+        renderer="rmc",
+        simplify=None,
+        precision=DEFAULT_PRECISION,
+        raster_threshold=DEFAULT_RASTER_THRESHOLD,
+        raster_dpi=DEFAULT_RASTER_DPI,
+):
+    """Render the annotations of a page onto page `page_idx` of `output_pdf`, or in its place.
+
+    Pages whose `render_cost` is above `raster_threshold` (if there is one) get their annotations as an image at
+    `raster_dpi` instead of as vectors."""
+    page = output_pdf.source[page_idx]
+
+    if parsed_page.version != ReMarkableAnnotationsFileHeaderVersion.V6:
+        scrybble_warning_only_v6_supported.render_as_annotation(output_pdf.page(page_idx))
+        return
+
+    cost = parsed_page.render_cost
+    if raster_threshold is not None and cost > raster_threshold:
+        logging.info(
+            f"- Page {page_idx + 1}: rendering cost {cost} is above {raster_threshold}, "
+            f"drawing the annotations as an image at {raster_dpi} dpi"
+        )
+    else:
+        logging.debug(f"- Page {page_idx + 1}: rendering cost {cost}, drawing the annotations as vectors")
+        raster_dpi = None
+
+    try:
+        background_is_empty = page.get_contents() == []
+        background = (page.cropbox.width, page.cropbox.height, page.rotation, background_is_empty)
+        overlay, (x_shift, y_shift, w_svg, h_svg) = render_overlay(
+            parsed_page, renderer, simplify, precision, raster_dpi, background
+        )
+
+        # if the background page is empty, the page is just the annotations
+        if background_is_empty:
+            output_pdf.replace_page(page_idx, overlay)
+            return
+
+        # The page as it is displayed, which is how the tablet shows it too
+        w_bg, h_bg = page.rect.width, page.rect.height
+        (width, height), bg_rect, svg_rect = place_on_background(
+            (w_bg, h_bg), (x_shift, y_shift, w_svg, h_svg)
+        )
+        if bg_rect != (0, 0, width, height) or page.rotation != 0:
+            page = output_pdf.new_page(page_idx, width, height, background=fitz.Rect(*bg_rect))
+        else:
+            # the annotations fit on the background page as it is
+            page = output_pdf.page(page_idx)
+        if overlay[0].get_contents() != []:
+            page.show_pdf_page(fitz.Rect(*svg_rect),
+                               overlay,
+                               0)
+
+        if parsed_page.data and "highlights" in parsed_page.data:
+            apply_smart_highlights(page, parsed_page.data["highlights"])
+    except AttributeError:
+        add_error_annotation(output_pdf.page(page_idx))
+
+
+# Bump this whenever the output of a renderer changes, so overlays rendered by older versions are thrown away
+RENDERED_OVERLAY_CACHE_VERSION = 4
+
+
+def render_overlay(
+        parsed_page: ParsedPage, renderer, simplify, precision, raster_dpi, background
+) -> Tuple[fitz.Document, Tuple[float, float, float, float]]:
+    """The annotations of a v6 page as a one-page PDF, along with its view box (x, y, width, height).
+
+    Overlays are cached by the content of the .rm file, the renderer and its settings and the geometry of the
+    background page, when the caches are enabled. `precision` only applies to the native renderer, and with a
+    `raster_dpi` the overlay is an image instead, see `render_raster`."""
+    cache = get_cache("overlays", RENDERED_OVERLAY_CACHE_VERSION)
+    if cache is not None:
+        with open_rm_file(parsed_page.path) as (_, mm):
+            key = cache.key(
+                mm, renderer, renderer_version(renderer), simplify, precision if renderer == "native" else None,
+                raster_dpi, background,
+            )
+        cached = cache.get(key)
+        if cached is not None:
+            view_box, arrays = cached
+            return fitz.open(stream=arrays["pdf"].tobytes(), filetype="pdf"), view_box
+
+    if raster_dpi is not None:
+        overlay, view_box = render_raster(parsed_page, raster_dpi)
+    elif renderer == "native":
+        overlay, view_box = render_pdf(parsed_page, precision)
+    else:
+        svg, view_box = render_svg(parsed_page.scene_tree())
+        overlay = fitz.open(stream=svg_to_pdf(svg), filetype="pdf")
+
+    if cache is not None:
+        cache.put(key, view_box, {"pdf": np.frombuffer(overlay.tobytes(), dtype=np.uint8)})
+    return overlay, view_box
+
+
+@functools.cache
+def renderer_version(renderer) -> str:
+    """The versions of the packages whose output ends up in the overlays of `renderer`"""
+    packages = ["rmscene", "PyMuPDF"] if renderer == "native" else ["rmscene", "rmc"]
+    return ",".join(f"{package}={importlib.metadata.version(package)}" for package in packages)
+
+
+# The document a worker of `render_pages_in_parallel` renders pages of: its metadata path, and what it opened of it
+_worker_document: Optional[Tuple[pathlib.Path, Document, fitz.Document]] = None
+
+
+def render_pages_in_parallel(
+        metadata_path: pathlib.Path,
+        pages: List[Tuple[str, int]],
+        renderer,
+        simplify,
+        precision,
+        raster_threshold,
+        raster_dpi,
+        pool: WatchdogPool,
+) -> Iterator[
+    Tuple[Tuple[bytes, Optional[fitz.Matrix]], Any, List[GlyphRange], Optional[SimplificationReport]] | RenderFailed
+]:
+    """Parse and render `pages` (uuid, index) of a document on the workers of `pool`, yielding the results in page
+    order.
+
+    The workers open the document themselves, once for all of its pages, and send back every rendered page as a
+    `PageFragment`, along with what the markdown needs. Pages that fail or go over the budgets of the pool come
+    back as a `RenderFailed`."""
+    return pool.map(
+        _render_page_in_worker,
+        itertools.repeat(metadata_path),
+        [page_uuid for page_uuid, _ in pages],
+        [page_idx for _, page_idx in pages],
+        itertools.repeat(renderer),
+        itertools.repeat(simplify),
+        itertools.repeat(precision),
+        itertools.repeat(raster_threshold),
+        itertools.repeat(raster_dpi),
+    )
+
+
+def _render_page_in_worker(
+        metadata_path: pathlib.Path, page_uuid: str, page_idx: int, renderer, simplify, precision, raster_threshold,
+        raster_dpi,
+):
+    global _worker_document
+    if _worker_document is None or _worker_document[0] != metadata_path:
+        document = Document(metadata_path)
+        # Sized like the source PDF of `process_document`, which leaves the parsing to the workers too
+        _worker_document = (metadata_path, document, document.open_source_pdf(parse_pages=False))
+    _, document, rmc_pdf_src = _worker_document
+
+    parsed_page = document.take_parsed_page(page_uuid)
+    report = simplify_page(parsed_page, simplify) if simplify else None
+
+    fragment = PageFragment(rmc_pdf_src, page_idx)
+    render_page(fragment, page_idx, parsed_page, renderer, simplify, precision, raster_threshold, raster_dpi)
+    return (fragment.tobytes(), fragment.background), parsed_page.text, parsed_page.highlights, report
+
+
 def add_error_annotation(page: Page, more_info=""):
     page.add_freetext_annot(
         rect=fitz.Rect(10, 10, 300, 30),
@@ -1,5 +1,6 @@
 from flask import Flask, request
 import remarks
+from remarks.output.RemarksPdf import SAVE_PROFILES
 import os, os.path
 
 app = Flask("Remarks http server")
@@ -17,6 +18,9 @@ def process():
     assert os.path.exists(in_path), f"Path does not exist: {in_path}"
     assert os.path.exists(out_path), f"Path does not exist: {out_path}"
 
+    save_profile = params.get('save_profile', "default")
+    assert save_profile in SAVE_PROFILES, f"Unknown save profile: {save_profile}"
+
     print(f"Got a request to process {params['in_path']}")
 
     parent_dir = in_path
@@ -26,7 +30,7 @@ def process():
     print(f"Making directory {out_dir}")
     os.makedirs(out_dir)
 
-    result = remarks.run_remarks(in_path, out_dir)
+    result = remarks.run_remarks(in_path, out_dir, save_profile=save_profile)
 
     return "OK"
 
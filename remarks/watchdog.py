@@ -0,0 +1,210 @@
+import collections
+import multiprocessing
+import multiprocessing.connection
+import os
+import signal
+import time
+import traceback
+from typing import Any, Callable, Dict, Iterator, List, Optional, Sequence, Tuple
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows, where there are no memory budgets
+    resource = None
+
+MEMORY_LIMITS_SUPPORTED = resource is not None
+
+# The address space limit of a worker from before it limited itself, for the processes it starts
+_inherited_address_space_limit: Optional[Tuple[int, int]] = None
+
+
+class RenderFailed(Exception):
+    """A task that raised, crashed its worker or went over its time or memory budget"""
+
+
+class WatchdogWorker:
+    """A forked process that runs tasks one at a time, and can be killed when one of them hangs.
+
+    Every worker leads a process group of its own, so the processes it started (Inkscape) are killed along with it."""
+
+    def __init__(
+            self,
+            memory_limit: Optional[int],
+            initializer: Optional[Callable] = None,
+            finalizer: Optional[Callable] = None,
+    ):
+        self.connection, child_connection = multiprocessing.Pipe()
+        self.process = multiprocessing.get_context("fork").Process(
+            target=_serve, args=(child_connection, memory_limit, initializer, finalizer), daemon=True
+        )
+        self.process.start()
+        # The worker exiting shows up as the end of the pipe, once this copy of its end is closed
+        child_connection.close()
+
+    def submit(self, function: Callable, args: Sequence):
+        self.connection.send((function, tuple(args)))
+
+    def result(self) -> Any:
+        try:
+            succeeded, value = self.connection.recv()
+        except (EOFError, OSError):
+            self.process.join()
+            raise RenderFailed(f"the worker exited with code {self.process.exitcode}")
+        if not succeeded:
+            raise RenderFailed(value)
+        return value
+
+    def close(self):
+        # Workers forked later hold copies of this end of the pipe, so the worker wouldn't see it closing
+        try:
+            self.connection.send(None)
+        except OSError:
+            pass
+        self.connection.close()
+        # Time for the finalizer
+        self.process.join(timeout=5)
+        if self.process.is_alive():
+            self._kill_group()
+
+    def kill(self):
+        self._kill_group()
+        self.connection.close()
+
+    def _kill_group(self):
+        try:
+            os.killpg(self.process.pid, signal.SIGKILL)
+        except (ProcessLookupError, PermissionError):
+            # Killed before it got to start its process group
+            self.process.kill()
+        self.process.join()
+
+
+class WatchdogPool:
+    """Runs tasks on at most `jobs` forked workers, each task within `timeout` seconds and with at most
+    `memory_limit` bytes of address space on top of what the worker started with.
+
+    A task that goes over its budget, raises or crashes its worker becomes a `RenderFailed` in the results
+    instead of stalling or ending everything else. Its worker is replaced, as it may be hung or in a bad state.
+    Memory limits need `MEMORY_LIMITS_SUPPORTED`.
+
+    Workers are kept for the next `map` until the pool is closed. Every worker calls `initializer` when it
+    starts, and `finalizer` when it is closed (but not when it is killed)."""
+
+    def __init__(
+            self,
+            jobs: int = 1,
+            timeout: Optional[float] = None,
+            memory_limit: Optional[int] = None,
+            initializer: Optional[Callable] = None,
+            finalizer: Optional[Callable] = None,
+    ):
+        if memory_limit is not None and not MEMORY_LIMITS_SUPPORTED:
+            raise ValueError("Memory limits are not supported on this platform")
+        self.jobs = max(jobs, 1)
+        self.timeout = timeout
+        self.memory_limit = memory_limit
+        self.initializer = initializer
+        self.finalizer = finalizer
+        self._idle: List[WatchdogWorker] = []
+
+    def map(self, function: Callable, *iterables) -> Iterator[Any]:
+        """Like `Executor.map`, but yields a `RenderFailed` for every task that failed rather than raising it"""
+        pending = collections.deque(enumerate(zip(*iterables)))
+        total = len(pending)
+        idle = self._idle
+        # Worker -> (task index, deadline)
+        busy: Dict[WatchdogWorker, Tuple[int, float]] = {}
+        results: Dict[int, Any] = {}
+        next_result = 0
+
+        try:
+            while next_result < total:
+                while pending and len(busy) < self.jobs:
+                    worker = idle.pop() if idle else WatchdogWorker(self.memory_limit, self.initializer, self.finalizer)
+                    index, args = pending.popleft()
+                    worker.submit(function, args)
+                    busy[worker] = (index, time.monotonic() + self.timeout if self.timeout else float("inf"))
+
+                wait = min(deadline for _, deadline in busy.values()) - time.monotonic()
+                ready = multiprocessing.connection.wait(
+                    [worker.connection for worker in busy], timeout=None if wait == float("inf") else max(wait, 0)
+                )
+                for worker in [worker for worker in busy if worker.connection in ready]:
+                    index, _ = busy.pop(worker)
+                    try:
+                        results[index] = worker.result()
+                        idle.append(worker)
+                    except RenderFailed as e:
+                        results[index] = e
+                        worker.kill()
+
+                now = time.monotonic()
+                for worker in [worker for worker, (_, deadline) in busy.items() if deadline <= now]:
+                    index, _ = busy.pop(worker)
+                    results[index] = RenderFailed(f"took longer than {self.timeout} seconds")
+                    worker.kill()
+
+                while next_result in results:
+                    yield results.pop(next_result)
+                    next_result += 1
+        finally:
+            # Workers still busy when the results are no longer wanted
+            for worker in busy:
+                worker.kill()
+
+    def close(self):
+        while self._idle:
+            self._idle.pop().close()
+
+
+def _serve(connection, memory_limit: Optional[int], initializer: Optional[Callable], finalizer: Optional[Callable]):
+    os.setsid()
+    if memory_limit is not None:
+        _limit_address_space(memory_limit)
+    if initializer is not None:
+        initializer()
+    try:
+        while True:
+            try:
+                task = connection.recv()
+            except EOFError:
+                return
+            if task is None:
+                return
+            function, args = task
+            try:
+                connection.send((True, function(*args)))
+            except MemoryError:
+                connection.send((False, "ran out of its memory budget"))
+            except Exception as e:
+                connection.send((False, "".join(traceback.format_exception_only(e)).strip()))
+    finally:
+        # Rather than left to finalizers, which the processes forked by multiprocessing start out without
+        if finalizer is not None:
+            finalizer()
+
+
+def _limit_address_space(extra: int):
+    """Allow `extra` bytes of address space on top of what the process uses already, which is inherited from
+    the process it was forked from"""
+    try:
+        with open("/proc/self/statm") as f:
+            current = int(f.read().split()[0]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        current = 0
+    global _inherited_address_space_limit
+    _inherited_address_space_limit = resource.getrlimit(resource.RLIMIT_AS)
+    _, hard = _inherited_address_space_limit
+    limit = current + extra
+    if hard != resource.RLIM_INFINITY:
+        limit = min(limit, hard)
+    resource.setrlimit(resource.RLIMIT_AS, (limit, hard))
+
+
+def restore_address_space():
+    """Lift the memory budget of a worker in a process it starts, before that runs anything else (as the
+    `preexec_fn` of `subprocess.Popen`). The budget is for the work of the worker itself, not for the programs
+    it runs, which would inherit it otherwise."""
+    if _inherited_address_space_limit is not None:
+        resource.setrlimit(resource.RLIMIT_AS, _inherited_address_space_limit)
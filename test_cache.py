@@ -0,0 +1,90 @@
+import os
+
+import numpy as np
+import pytest
+
+from remarks.cache import ContentCache, configure_cache, get_cache
+
+r"""
+  _____           _
+ / ____|         | |
+| |     __ _  ___| |__   ___
+| |    / _` |/ __| '_ \ / _ \
+| |___| (_| | (__| | | |  __/
+ \_____\__,_|\___|_| |_|\___|
+"""
+
+
+@pytest.mark.cache
+def test_entries_round_trip_as_memory_maps(tmp_path):
+    cache = ContentCache(tmp_path, "pages", 1, max_bytes=1024 * 1024)
+    key = cache.key(b"some .rm bytes", 1404, 1872)
+
+    assert cache.get(key) is None
+    cache.put(key, {"version": 6}, {"points": np.arange(6, dtype=np.float32).reshape(3, 2)})
+
+    meta, arrays = cache.get(key)
+    assert meta == {"version": 6}
+    assert isinstance(arrays["points"], np.memmap)
+    assert arrays["points"].tolist() == [[0, 1], [2, 3], [4, 5]]
+
+
+@pytest.mark.cache
+def test_least_recently_used_entries_are_evicted(tmp_path):
+    cache = ContentCache(tmp_path, "pages", 1, max_bytes=2500)
+    payload = {"points": np.zeros(200, dtype=np.float32)}
+
+    cache.put("a" * 40, None, payload)
+    cache.put("b" * 40, None, payload)
+    # Make "a" the oldest, then use it, so "b" is the least recently used entry
+    os.utime(tmp_path / "pages-v1" / "aa" / ("a" * 40), (0, 0))
+    os.utime(tmp_path / "pages-v1" / "bb" / ("b" * 40), (1, 1))
+    assert cache.get("a" * 40) is not None
+    cache.put("c" * 40, None, payload)
+
+    assert cache.get("a" * 40) is not None
+    assert cache.get("b" * 40) is None
+    assert cache.get("c" * 40) is not None
+
+
+@pytest.mark.cache
+def test_the_cache_is_only_counted_once_while_it_fits(tmp_path, monkeypatch):
+    ContentCache(tmp_path, "pages", 1, max_bytes=1024 * 1024).put("a" * 40, None)
+    cache = ContentCache(tmp_path, "pages", 1, max_bytes=1024 * 1024)
+    scans = []
+    scan = cache.budget._scan
+    monkeypatch.setattr(cache.budget, "_scan", lambda: scans.append(1) or scan())
+
+    for key in "bcdef":
+        cache.put(key * 40, None, {"points": np.zeros(200, dtype=np.float32)})
+
+    assert len(scans) == 1
+    assert cache.budget._size == sum(size for _, size, _ in scan())
+
+
+@pytest.mark.cache
+def test_namespaces_share_the_cache_size(tmp_path):
+    configure_cache(tmp_path, max_bytes=2500)
+    payload = {"points": np.zeros(200, dtype=np.float32)}
+    try:
+        get_cache("pages", 1).put("a" * 40, None, payload)
+        os.utime(tmp_path / "pages-v1" / "aa" / ("a" * 40), (0, 0))
+        get_cache("scenes", 1).put("b" * 40, None, payload)
+        get_cache("overlays", 1).put("c" * 40, None, payload)
+
+        # Each entry fits on its own, but the three of them together don't
+        assert get_cache("pages", 1).get("a" * 40) is None
+        assert get_cache("scenes", 1).get("b" * 40) is not None
+        assert get_cache("overlays", 1).get("c" * 40) is not None
+    finally:
+        configure_cache(None)
+
+
+@pytest.mark.cache
+def test_new_format_versions_drop_old_entries(tmp_path):
+    ContentCache(tmp_path, "pages", 1, max_bytes=1024).put("a" * 40, None)
+
+    cache = ContentCache(tmp_path, "pages", 2, max_bytes=1024)
+
+    assert not (tmp_path / "pages-v1").exists()
+    assert cache.get("a" * 40) is None
@@ -0,0 +1,65 @@
+import numpy as np
+import pytest
+from rmscene.scene_items import Rectangle
+
+from remarks.dimensions import (
+    AffineTransform,
+    REMARKABLE_DOCUMENT,
+    RM_TO_MU,
+    place_on_background,
+)
+
+r"""
+ _____  _                          _
+|  __ \(_)                        (_)
+| |  | |_ _ __ ___   ___ _ __  ___ _  ___  _ __  ___
+| |  | | | '_ ` _ \ / _ \ '_ \/ __| |/ _ \| '_ \/ __|
+| |__| | | | | | | |  __/ | | \__ \ | (_) | | | \__ \
+|_____/|_|_| |_| |_|\___|_| |_|___/_|\___/|_| |_|___/
+"""
+
+
+@pytest.mark.dimensions
+def test_transforms_compose_and_apply_to_arrays():
+    transform = AffineTransform.translate(10, 20) @ AffineTransform.scale(2, 3)
+    points = np.array([(0, 0), (1, 1), (-2, 5)], dtype=np.float32)
+
+    moved = transform.apply(points)
+
+    assert moved.dtype == np.float32
+    assert moved.tolist() == [[10, 20], [12, 23], [6, 35]]
+    assert transform.apply_xy(1, 1) == (12, 23)
+    assert np.allclose(transform.inverse().apply(moved), points)
+
+
+@pytest.mark.dimensions
+def test_page_sizes_go_through_the_unit_transforms():
+    mu = REMARKABLE_DOCUMENT.to_mm().to_mu()
+
+    assert (mu.width, mu.height) == (741, 1048)
+    width, height = RM_TO_MU.apply_size(REMARKABLE_DOCUMENT.width, REMARKABLE_DOCUMENT.height)
+    assert (int(width), int(height)) == (mu.width, mu.height)
+
+
+@pytest.mark.dimensions
+def test_rectangles_are_transformed_in_place():
+    rectangles = [Rectangle(1, 2, 3, 4), Rectangle(-1, 0, 10, 1)]
+
+    (AffineTransform.translate(5, 5) @ AffineTransform.scale(2)).apply_rectangles(rectangles)
+
+    assert rectangles == [Rectangle(7, 9, 6, 8), Rectangle(3, 5, 20, 2)]
+
+
+@pytest.mark.dimensions
+def test_annotations_are_centered_on_narrower_backgrounds():
+    # An A4 background below an annotations page that is wider and longer than it
+    size, bg_rect, svg_rect = place_on_background((595, 842), (-400, 0, 800, 1000))
+
+    assert size == (800, 1000)
+    assert bg_rect == (102.5, 0, 697.5, 842)
+    assert svg_rect == (0, 0, 800, 1000)
+
+    size, bg_rect, svg_rect = place_on_background((800, 1000), (-200, 10, 400, 500))
+    assert size == (800, 1000)
+    assert bg_rect == (0, 0, 800, 1000)
+    assert svg_rect == (200, 10, 600, 510)
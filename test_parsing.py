@@ -0,0 +1,467 @@
+import io
+import re
+import struct
+import zipfile
+
+import fitz
+import numpy as np
+import pytest
+from rmscene import SceneLineItemBlock, read_blocks
+from rmscene.scene_stream import point_from_stream
+from rmscene.scene_items import Line
+from rmscene.tagged_block_reader import TaggedBlockReader
+
+import remarks.Document as document_module
+from remarks import run_remarks
+from remarks.cache import configure_cache
+from remarks.conversion import parsing
+from remarks.conversion.parsing import (
+    decode_v3_to_v5,
+    parse_v3_to_v5,
+    adjust_xypos_sizes,
+    rescale_parsed_data,
+    get_ann_max_bound,
+    probe_rm_file,
+    parse_page,
+    read_scene,
+    iter_blocks,
+    PointArray,
+    StrokesBuilder,
+)
+from remarks.conversion.drawing import annotations_view_box, draw_annotations, render_pdf, render_svg
+from remarks.conversion.erase import erase_strokes, ERASER, ERASE_AREA
+from remarks.conversion.simplify import ramer_douglas_peucker, simplify_page
+from remarks.conversion.spatial import StrokeIndex
+from remarks.metadata import ReMarkableAnnotationsFileHeaderVersion
+from remarks.dimensions import REMARKABLE_DOCUMENT
+
+r"""
+ _____                _
+|  __ \              (_)
+| |__) |_ _ _ __ ___ _ _ __   __ _
+|  ___/ _` | '__/ __| | '_ \ / _` |
+| |  | (_| | |  \__ \ | | | | (_| |
+|_|   \__,_|_|  |___/_|_| |_|\__, |
+                              __/ |
+                             |___/
+"""
+
+
+def v5_page(strokes):
+    """Builds the body (everything after the header) of a single-layer v5 .rm file"""
+    data = struct.pack("<I", len(strokes))
+    for pen, color, width, points in strokes:
+        data += struct.pack("<IIIffI", pen, color, 0, width, 0, len(points))
+        for x, y in points:
+            data += struct.pack("<ffffff", x, y, 0.5, 0.1, 0, 0)
+    return data
+
+
+def v6_bytes(rmn="rmpp - v6 - black and white only.rmn"):
+    """The first .rm page of a test notebook"""
+    with zipfile.ZipFile(f"tests/in/{rmn}") as zf:
+        name = next(n for n in zf.namelist() if n.endswith(".rm"))
+        return zf.read(name)
+
+
+def v6_page(tmp_path, rmn="rmpp - v6 - black and white only.rmn"):
+    rm_file = tmp_path / "page.rm"
+    rm_file.write_bytes(v6_bytes(rmn))
+    return rm_file
+
+
+@pytest.fixture
+def scene_cache(tmp_path):
+    configure_cache(tmp_path / "cache")
+    yield
+    configure_cache(None)
+
+
+@pytest.mark.parsing
+def test_v5_decoder_reads_points_without_copying():
+    data = v5_page([(2, 0, 2.0, [(1, 2), (3, 4), (5, 6)]), (4, 1, 1.0, [(7, 8)])])
+
+    (strokes,) = decode_v3_to_v5(data, False, 1, 0)
+
+    assert [s["pen"] for s in strokes] == [2, 4]
+    assert strokes[0]["points"]["x"].tolist() == [1, 3, 5]
+    assert strokes[1]["points"]["y"].tolist() == [8]
+    assert strokes[0]["points"].base is not None
+
+
+@pytest.mark.parsing
+def test_v5_decoder_matches_per_point_adjustment():
+    points = [(100.5, 200.25), (1403.0, 1871.0)]
+    data = v5_page([(2, 0, 2.0, points)])
+
+    layers, _ = parse_v3_to_v5(data, REMARKABLE_DOCUMENT, False, 1, 0)
+
+    strokes = layers["layers"][0]["strokes"]
+    expected = [adjust_xypos_sizes(x, y, REMARKABLE_DOCUMENT) for x, y in points]
+    assert strokes.tool_names() == ["Ballpoint_2"]
+    assert np.allclose(strokes.stroke(0), expected)
+
+
+@pytest.mark.parsing
+def test_strokes_are_stored_column_wise():
+    data = v5_page([(2, 0, 2.0, [(1, 2), (3, 4), (5, 6)]), (5, 3, 1.0, [(7, 8)]), (4, 1, 1.0, [(9, 10), (11, 12)])])
+
+    layers, has_highlighter = parse_v3_to_v5(data, REMARKABLE_DOCUMENT, False, 1, 0)
+
+    strokes = layers["layers"][0]["strokes"]
+    assert has_highlighter
+    assert len(strokes) == 3
+    assert strokes.points.dtype == np.float32
+    assert strokes.points.shape == (6, 2)
+    assert strokes.offsets.tolist() == [0, 3, 4, 6]
+    assert strokes.colors.tolist() == [0, 3, 1]
+    assert strokes.opacities[1] == pytest.approx(0.6)
+
+
+@pytest.mark.parsing
+def test_rescale_and_bounds_work_on_arrays():
+    data = v5_page([(2, 0, 2.0, [(0, 0), (100, 50)]), (2, 0, 2.0, [(5000, 5000)])])
+    layers, _ = parse_v3_to_v5(data, REMARKABLE_DOCUMENT, False, 1, 0)
+
+    rescale_parsed_data(layers, 2, 10, 20)
+
+    # The single point stroke is ignored
+    x_max, y_max, x_min, y_min = get_ann_max_bound(layers)
+    expected_x, expected_y = adjust_xypos_sizes(100, 50, REMARKABLE_DOCUMENT)
+    assert (x_min, y_min) == (10, 20)
+    assert x_max == pytest.approx(expected_x * 2 + 10, abs=1e-3)
+    assert y_max == pytest.approx(expected_y * 2 + 20, abs=1e-3)
+
+
+@pytest.mark.parsing
+def test_probe_reads_only_the_header(tmp_path):
+    rm_file = tmp_path / "page.rm"
+    body = v5_page([(2, 0, 2.0, [(1, 2), (3, 4)])])
+    rm_file.write_bytes(b"reMarkable .lines file, version=5          " + struct.pack("<I", 1) + body)
+
+    header = probe_rm_file(rm_file)
+
+    assert header.version == ReMarkableAnnotationsFileHeaderVersion.V5
+    assert header.nlayers == 1
+    assert header.size == rm_file.stat().st_size
+    assert len(parse_page(rm_file).data["layers"][0]["strokes"]) == 1
+
+
+@pytest.mark.parsing
+def test_probe_handles_empty_files(tmp_path):
+    rm_file = tmp_path / "empty.rm"
+    rm_file.write_bytes(b"")
+
+    assert probe_rm_file(rm_file).version == ReMarkableAnnotationsFileHeaderVersion.UNKNOWN
+    with pytest.raises(ValueError):
+        parse_page(rm_file)
+
+
+@pytest.mark.parsing
+@pytest.mark.parametrize("body, error", [
+    (v5_page([(2, 0, 2.0, [(1, 2), (3, 4)]), (99, 0, 2.0, [(5, 6)])]), KeyError),
+    # The second stroke claims more points than there are left in the file
+    (v5_page([(2, 0, 2.0, [(1, 2), (3, 4)]), (2, 0, 2.0, [(5, 6)])])[:-24] + struct.pack("<I", 0), ValueError),
+], ids=["unknown pen", "truncated"])
+def test_corrupt_pages_raise_their_own_error(tmp_path, body, error):
+    rm_file = tmp_path / "page.rm"
+    rm_file.write_bytes(b"reMarkable .lines file, version=5          " + struct.pack("<I", 1) + body)
+
+    # Not a BufferError from closing the file while the error still points into it
+    with pytest.raises(error):
+        parse_page(rm_file)
+
+
+@pytest.mark.parsing
+def test_per_stroke_bounding_boxes():
+    builder = StrokesBuilder()
+    builder.add(2, 0, 1.0, 1.0, np.array([(1, 5), (3, 2)]))
+    builder.add(2, 0, 1.0, 1.0, np.empty((0, 2)))
+    builder.add(2, 0, 1.0, 1.0, np.array([(-4, 7)]))
+
+    strokes = builder.build()
+
+    assert strokes.bboxes[0].tolist() == [1, 2, 3, 5]
+    assert np.isnan(strokes.bboxes[1]).all()
+    assert strokes.bboxes[2].tolist() == [-4, 7, -4, 7]
+    assert strokes.bounds() == (-4, 2, 3, 7)
+    assert strokes.bounds(min_points=2) == (1, 2, 3, 5)
+
+
+@pytest.mark.parsing
+def test_stroke_index_answers_rectangle_queries():
+    rng = np.random.default_rng(0)
+    builder = StrokesBuilder()
+    for center in rng.uniform(-3000, 3000, (500, 2)):
+        builder.add(2, 0, 1.0, 1.0, center + rng.normal(0, 30, (10, 2)))
+    # A stroke across the whole canvas, which is too large to be put in the grid
+    builder.add(2, 0, 1.0, 1.0, np.array([(-3000, -3000), (3000, 3000)]))
+    strokes = builder.build()
+
+    index = StrokeIndex(strokes.bboxes)
+    for rect in [(0, 0, 1404, 1872), (-5000, -5000, 5000, 5000), (8000, 8000, 9000, 9000)]:
+        x_min, y_min, x_max, y_max = rect
+        bboxes = strokes.bboxes
+        expected = np.flatnonzero(
+            (bboxes[:, 0] <= x_max) & (bboxes[:, 2] >= x_min) & (bboxes[:, 1] <= y_max) & (bboxes[:, 3] >= y_min)
+        )
+        assert index.query(*rect).tolist() == expected.tolist()
+
+
+@pytest.mark.parsing
+def test_simplification_stays_within_tolerance():
+    t = np.linspace(0, 2 * np.pi, 500)
+    points = np.stack([np.cos(t) * 100, np.sin(t) * 100 + t], axis=1)
+
+    keep = ramer_douglas_peucker(points, 0.5)
+
+    assert keep[0] and keep[-1]
+    assert keep.sum() < len(points) / 4
+    # Every point lies close to the simplified polyline
+    kept = points[keep]
+    for point in points:
+        a, b = kept[:-1], kept[1:]
+        t = np.clip(((point - a) * (b - a)).sum(axis=1) / ((b - a) ** 2).sum(axis=1), 0, 1)
+        assert np.min(np.hypot(*(a + t[:, None] * (b - a) - point).T)) <= 0.5 + 1e-6
+
+
+@pytest.mark.parsing
+def test_simplify_page_updates_strokes_and_tree(tmp_path):
+    page = parse_page(v6_page(tmp_path))
+    before = page.data["layers"][0]["strokes"]
+
+    report = simplify_page(page, 0.2)
+
+    after = page.data["layers"][0]["strokes"]
+    assert report.points_before == len(before.points)
+    assert report.points_after == len(after.points) < len(before.points)
+    assert len(after) == len(before)
+    assert after.tools.tolist() == before.tools.tolist()
+    lines = [el for el in page.tree.walk() if isinstance(el, Line)]
+    assert [len(line.points) for line in lines[:len(after)]] == after.point_counts().tolist()
+
+
+@pytest.mark.parsing
+def test_appended_v6_pages_are_parsed_incrementally(tmp_path, scene_cache, monkeypatch):
+    data = v6_bytes()
+    # Cut the file at a block boundary, as if the rest was written later
+    block_ends = [end for _, end in iter_blocks(io.BytesIO(data))]
+    cut = block_ends[len(block_ends) // 2]
+    rm_file = tmp_path / "page.rm"
+    rm_file.write_bytes(data[:cut])
+    parse_page(rm_file)
+
+    offsets = []
+    real_read_scene = parsing.read_scene
+    monkeypatch.setattr(parsing, "read_scene", lambda mm, tree=None, offset=0: offsets.append(offset) or real_read_scene(mm, tree, offset))
+    rm_file.write_bytes(data)
+    resumed = parse_page(rm_file)
+
+    assert offsets == [cut]
+    expected = parsing.parse_v6_scene(real_read_scene(io.BytesIO(data))[0])
+    assert np.array_equal(resumed.data["layers"][0]["strokes"].points, expected["layers"][0]["strokes"].points)
+
+
+@pytest.mark.parsing
+def test_cached_pages_take_their_scene_tree_from_the_cache(tmp_path, scene_cache, monkeypatch):
+    rm_file = v6_page(tmp_path)
+    parse_page(rm_file)
+
+    offsets = []
+    real_read_scene = parsing.read_scene
+    monkeypatch.setattr(parsing, "read_scene", lambda mm, tree=None, offset=0: offsets.append(offset) or real_read_scene(mm, tree, offset))
+    page = parse_page(rm_file)
+    assert page.tree is None
+    tree = page.scene_tree()
+
+    # Nothing is decoded again
+    assert offsets == [rm_file.stat().st_size]
+    assert len(list(tree.walk())) == len(list(real_read_scene(io.BytesIO(rm_file.read_bytes()))[0].walk()))
+
+
+@pytest.mark.parsing
+def test_rewritten_v6_pages_are_parsed_from_the_start(tmp_path, scene_cache):
+    rm_file = v6_page(tmp_path)
+    parse_page(rm_file)
+
+    other = v6_bytes("rmpp - v6 - various colors.rmn")
+    rm_file.write_bytes(other)
+    page = parse_page(rm_file)
+
+    expected = parsing.parse_v6_scene(read_scene(io.BytesIO(other))[0])
+    assert np.array_equal(page.data["layers"][0]["strokes"].points, expected["layers"][0]["strokes"].points)
+
+
+@pytest.mark.parsing
+def test_line_points_are_decoded_like_rmscene():
+    data = v6_bytes("rmpp - v6 - various colors.rmn")
+
+    expected = [b.item.value for b in read_blocks(io.BytesIO(data)) if isinstance(b, SceneLineItemBlock)]
+    blocks = [block for block, _ in iter_blocks(io.BytesIO(data))]
+    lines = [b.item.value for b in blocks if isinstance(b, SceneLineItemBlock)]
+
+    assert len(lines) == len(expected)
+    assert all(isinstance(line.points, PointArray) for line in lines if line is not None)
+    for line, expected_line in zip(lines, expected):
+        if expected_line is None:
+            assert line is None
+            continue
+        assert list(line.points) == expected_line.points
+        assert (line.tool, line.color, line.thickness_scale, line.move_id) == (
+            expected_line.tool, expected_line.color, expected_line.thickness_scale, expected_line.move_id
+        )
+
+
+@pytest.mark.parsing
+def test_version_1_points_are_converted_like_rmscene():
+    payload = struct.pack("<6f", 10.5, -3.25, 0.75, 1.5, 0.6, 0.4) + struct.pack("<6f", 1, 2, 3, 4, 5, 0.125)
+
+    points = PointArray.decode(payload, 1)
+
+    stream = TaggedBlockReader(io.BytesIO(payload))
+    assert list(points) == [point_from_stream(stream, version=1) for _ in range(2)]
+    assert points.xy().tolist() == [[10.5, -3.25], [1, 2]]
+    assert list(points[np.array([False, True])]) == [points[1]]
+
+
+@pytest.mark.parsing
+def test_erasers_remove_and_split_the_ink_below_them():
+    builder = StrokesBuilder()
+    # A line with a point every 10 units, and a dot far away
+    builder.add(2, 0, 2.0, 1.0, np.array([(x, 0) for x in range(0, 101, 10)]))
+    builder.add(2, 0, 2.0, 1.0, np.array([(500, 500)]))
+    # A line with only its ends, erased through the middle
+    builder.add(2, 0, 2.0, 1.0, np.array([(0, 50), (100, 50)]))
+    # Erase x=40..60 (radius 10 around x=50) across both lines
+    builder.add(ERASER, 0, 20.0, 1.0, np.array([(50, -10), (50, 60)]))
+    # Erase the dot with an area, and draw a line through the erased area afterwards
+    builder.add(ERASE_AREA, 0, 1.0, 0.0, np.array([(490, 490), (510, 490), (510, 510), (490, 510)]))
+    builder.add(4, 0, 2.0, 1.0, np.array([(50, -10), (50, 60)]))
+
+    strokes = erase_strokes(builder.build())
+
+    assert strokes.tools.tolist() == [2, 2, 2, 2, 4]
+    assert strokes.stroke(0)[:, 0].tolist() == [0, 10, 20, 30]
+    assert strokes.stroke(1)[:, 0].tolist() == [70, 80, 90, 100]
+    assert strokes.stroke(2).tolist() == [[0, 50]]
+    assert strokes.stroke(3).tolist() == [[100, 50]]
+    assert strokes.stroke(4).tolist() == [[50, -10], [50, 60]]
+    assert strokes.bounds() == (0, -10, 100, 60)
+
+
+@pytest.mark.pdf
+def test_native_renderer_draws_every_stroke(tmp_path):
+    page = parse_page(v6_page(tmp_path))
+    strokes = page.data["layers"][0]["strokes"]
+    x, y, width, height = annotations_view_box(page)
+    assert (x, y) == (-702 * 72 / 226, 0)
+
+    doc = fitz.open()
+    pdf_page = doc.new_page(width=width, height=height)
+    draw_annotations(pdf_page, page, pdf_page.rect, precision=1)
+
+    drawings = pdf_page.get_drawings()
+    # Strokes of the same pen are drawn as one path, with a line segment per pair of points
+    pens = list(zip(strokes.tools.tolist(), strokes.colors.tolist()))
+    assert 1 + sum(a != b for a, b in zip(pens, pens[1:])) <= len(drawings) < len(strokes)
+    widths = strokes.widths * 72 / 226
+    for drawing in drawings:
+        assert widths.min() / 1.15 <= drawing["width"] <= widths.max() * 1.15
+    content = pdf_page.read_contents().decode()
+    assert content.count(" l\n") == np.maximum(np.diff(strokes.offsets) - 1, 1).sum()
+    assert re.findall(r"\d+\.\d+ \S+ [ml]\n", content)
+    assert not re.findall(r"\d+\.\d\d+ \S+ [ml]\n", content)
+    # The strokes end up where the view box puts them
+    x_min, y_min, x_max, y_max = strokes.bounds()
+    scale = 72 / 226
+    ink = fitz.Rect()
+    for drawing in drawings:
+        ink |= drawing["rect"]
+    assert ink.x0 == pytest.approx((x_min * scale - x) - drawings[0]["width"] / 2, abs=2)
+    assert ink.y1 == pytest.approx((y_max * scale - y) + drawings[0]["width"] / 2, abs=2)
+
+
+@pytest.mark.pdf
+@pytest.mark.parametrize("rmn", ["rmpp - v6 - various colors.rmn", "rmpp - v6 - black and white only.rmn"])
+def test_native_renderer_batches_handwriting(tmp_path, rmn):
+    page = parse_page(v6_page(tmp_path, rmn))
+    strokes = page.data["layers"][0]["strokes"]
+
+    doc, _ = render_pdf(page)
+
+    # Pressure gives every stroke its own width, which must not give every stroke its own path
+    assert len(doc[0].get_drawings()) < len(strokes) / 2
+
+
+@pytest.mark.pdf
+def test_native_renderer_erases_instead_of_painting_white(tmp_path):
+    page = parse_page(v6_page(tmp_path))
+    strokes = page.data["layers"][0]["strokes"]
+    builder = StrokesBuilder()
+    for i in range(len(strokes)):
+        builder.add(int(strokes.tools[i]), int(strokes.colors[i]), float(strokes.widths[i]), 1.0, strokes.stroke(i))
+    # Through the middle of all the ink
+    x_min, y_min, x_max, y_max = strokes.bounds()
+    builder.add(ERASER, 0, 20.0, 1.0, np.array([((x_min + x_max) / 2, y_min - 10), ((x_min + x_max) / 2, y_max + 10)]))
+    page.data["layers"][0]["strokes"] = builder.build()
+
+    doc = fitz.open()
+    pdf_page = doc.new_page(width=annotations_view_box(page)[2], height=annotations_view_box(page)[3])
+    draw_annotations(pdf_page, page, pdf_page.rect)
+
+    colors = {drawing["color"] for drawing in pdf_page.get_drawings()}
+    assert (1.0, 1.0, 1.0) not in colors
+    segments = pdf_page.read_contents().decode().count(" l\n")
+    assert segments < np.maximum(np.diff(strokes.offsets) - 1, 1).sum()
+
+
+def ink(doc: fitz.Document) -> int:
+    """Pixels that are not (nearly) white, whatever their color"""
+    pixmap = doc[0].get_pixmap(dpi=72, colorspace=fitz.csGRAY)
+    return sum(1 for value in pixmap.samples if value < 200)
+
+
+@pytest.mark.pdf
+@pytest.mark.parametrize("rmn, tolerance", [
+    ("rmpp - v6 - black and white only.rmn", 0.05),
+    # rmc shades the ballpoint by pressure, the native renderer draws it in its color
+    ("rmpp - v6 - various colors.rmn", 0.2),
+])
+def test_native_renderer_draws_as_much_ink_as_rmc(tmp_path, rmn, tolerance):
+    page = parse_page(v6_page(tmp_path, rmn))
+
+    native, _ = render_pdf(page)
+    # MuPDF reads SVGs too, which leaves Inkscape out of the comparison
+    svg, _ = render_svg(page.scene_tree())
+    rmc = fitz.open(stream=svg.encode(), filetype="svg")
+
+    assert ink(native) == pytest.approx(ink(rmc), rel=tolerance)
+
+
+@pytest.mark.pdf
+def test_rmc_view_box_is_returned_with_the_svg(tmp_path):
+    page = parse_page(v6_page(tmp_path))
+
+    svg, view_box = render_svg(page.scene_tree())
+
+    header = next(line for line in svg.splitlines() if line.startswith("<svg "))
+    assert f'viewBox="{" ".join(map(str, view_box))}"' in header
+    assert view_box == pytest.approx(annotations_view_box(page))
+
+
+@pytest.mark.parsing
+def test_pages_are_parsed_once_and_dropped_once_rendered(tmp_path, monkeypatch):
+    parsed, documents = [], []
+    monkeypatch.setattr(document_module, "parse_page", lambda path: parsed.append(path.stem) or parse_page(path))
+    document_init = document_module.Document.__init__
+
+    def keep_document(document, *args):
+        document_init(document, *args)
+        documents.append(document)
+
+    monkeypatch.setattr(document_module.Document, "__init__", keep_document)
+    run_remarks("tests/in/rmpp - v6 - various colors.rmn", str(tmp_path), renderer="native")
+
+    (document,) = documents
+    assert sorted(parsed) == sorted({path.stem for path in document.rm_annotation_files})
+    assert document._parsed_pages == {}
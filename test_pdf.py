@@ -1,5 +1,22 @@
+import functools
+import logging
+import os
+import pathlib
+import shutil
+import subprocess
+import sys
+import time
+
+import fitz
 import pytest
 
+import remarks
+from remarks.cache import configure_cache
+from remarks.inkscape import INKSCAPE_EXECUTABLES, INKSCAPE_PREEXEC, SCRATCH_ROOT, InkscapePool
+from remarks.output.PngExport import PngExport
+from remarks.output.RemarksPdf import RemarksPdf
+from remarks.watchdog import MEMORY_LIMITS_SUPPORTED, RenderFailed, WatchdogPool
+
 from tests.pdf_test_support import assert_page_renders_without_warnings, assert_warning_exists, extract_annot
 from tests.notebook_fixtures import *
 
@@ -54,3 +71,365 @@ def test_smart_highlights(notebook, remarks_document):
             text = extract_annot(annotation, words_on_page)
             assert text == page_highlights[i]
             # We should implement the colour check as well, once that is ready.
+
+
+@pytest.mark.pdf
+def test_output_pdf_replaces_pages_in_place(tmp_path):
+    source = fitz.open()
+    for i in range(5):
+        source.new_page(width=100 + i, height=100)
+    replacement = fitz.open()
+    replacement.new_page(width=50, height=50)
+
+    output = RemarksPdf(source)
+    output.replace_page(3, replacement)
+    output.new_page(1, 10, 10)
+    with pytest.raises(ValueError):
+        output.new_page(3, 10, 10)
+    output.save(str(tmp_path / "out"))
+
+    result = fitz.open(tmp_path / "out _remarks.pdf")
+    assert [page.rect.width for page in result] == [100, 10, 102, 50, 104]
+
+
+@pytest.mark.pdf
+def test_links_labels_and_forms_survive(tmp_path):
+    source = fitz.open()
+    for i in range(3):
+        source.new_page(width=100, height=100).draw_line((0, 10), (100, 10))
+    source.set_page_labels([{"startpage": 0, "prefix": "A-", "style": "D", "firstpagenum": 1}])
+    source[0].insert_link({"kind": fitz.LINK_GOTO, "from": fitz.Rect(10, 20, 30, 40), "page": 2})
+    source[2].insert_link({"kind": fitz.LINK_GOTO, "from": fitz.Rect(10, 20, 30, 40), "page": 0})
+    source.xref_set_key(source.pdf_catalog(), "Dests", f"<</appendix [{source[2].xref} 0 R /Fit]>>")
+    field = fitz.Widget()
+    field.field_type, field.field_name, field.rect = fitz.PDF_WIDGET_TYPE_TEXT, "name", fitz.Rect(10, 50, 90, 70)
+    source[1].add_widget(field)
+    source = fitz.open("pdf", source.tobytes())
+
+    output = RemarksPdf(source)
+    # Room for annotations on the left, which moves the link on the page along
+    output.new_page(2, 150, 100, background=fitz.Rect(50, 0, 150, 100))
+    output.new_page(1, 100, 100, background=fitz.Rect(0, 0, 100, 100))
+    output.save(str(tmp_path / "out"))
+
+    result = fitz.open(tmp_path / "out _remarks.pdf")
+    assert [result[page_idx].get_label() for page_idx in range(3)] == ["A-1", "A-2", "A-3"]
+    assert [link["page"] for link in result[0].get_links()] == [2]
+    (link,) = result[2].get_links()
+    assert link["page"] == 0 and link["from"] == fitz.Rect(60, 20, 80, 40)
+    assert result.xref_get_key(result.pdf_catalog(), "Dests/appendix")[1].startswith(f"[{result[2].xref} 0 R")
+    assert result.is_form_pdf and [widget.field_name for widget in result[1].widgets()] == ["name"]
+
+
+def ink_box(page: fitz.Page) -> fitz.Rect:
+    """Where the dark pixels of a page are, at 72 dpi"""
+    pixmap = page.get_pixmap(colorspace=fitz.csGRAY)
+    dark = [i for i, value in enumerate(pixmap.samples) if value < 100]
+    xs, ys = [i % pixmap.width for i in dark], [i // pixmap.width for i in dark]
+    return fitz.Rect(min(xs), min(ys), max(xs) + 1, max(ys) + 1)
+
+
+@pytest.mark.pdf
+@pytest.mark.parametrize("rotation", [90, 180, 270])
+def test_rotated_pages_are_shown_with_their_links_in_place(tmp_path, rotation):
+    source = fitz.open()
+    for _ in range(2):
+        page = source.new_page(width=100, height=200)
+        # A link on a black box, which should stay on top of each other
+        page.draw_rect(fitz.Rect(10, 20, 40, 30), fill=(0, 0, 0))
+        page.insert_link({"kind": fitz.LINK_GOTO, "from": fitz.Rect(10, 20, 40, 30), "page": 0})
+        page.set_rotation(rotation)
+    source = fitz.open("pdf", source.tobytes())
+    shown = ink_box(source[1])
+
+    output = RemarksPdf(source)
+    width, height = source[1].rect.width, source[1].rect.height
+    output.new_page(1, width + 50, height, background=fitz.Rect(50, 0, width + 50, height))
+    output.save(str(tmp_path / "out"))
+
+    result = fitz.open(tmp_path / "out _remarks.pdf")
+    page = result[1]
+    assert page.rotation == 0
+    assert ink_box(page) == shown + (50, 0, 50, 0)
+    (link,) = page.get_links()
+    assert tuple(link["from"]) == pytest.approx(tuple(shown + (50, 0, 50, 0)), abs=1)
+
+
+@pytest.mark.pdf
+@pytest.mark.skipif(
+    not any(shutil.which(executable) for executable in INKSCAPE_EXECUTABLES), reason="Inkscape is not installed"
+)
+def test_inkscape_pool_replaces_workers_that_exited():
+    svg = '<svg xmlns="http://www.w3.org/2000/svg" width="100" height="50"><rect width="10" height="10"/></svg>'
+    pool = InkscapePool(1)
+    try:
+        assert fitz.open(stream=pool.svg_to_pdf(svg), filetype="pdf").page_count == 1
+        worker = pool._idle.get()
+        if SCRATCH_ROOT is not None:
+            assert os.path.dirname(worker.scratch_dir) == SCRATCH_ROOT
+        worker.process.kill()
+        worker.process.wait()
+        pool._idle.put(worker)
+
+        assert fitz.open(stream=pool.svg_to_pdf(svg), filetype="pdf").page_count == 1
+        new_worker = pool._idle.get()
+        pool._idle.put(new_worker)
+        assert new_worker is not worker
+    finally:
+        pool.close()
+
+
+@pytest.mark.pdf
+def test_parallel_rendering_matches_sequential_rendering(tmp_path):
+    notebook = "tests/in/on computable numbers - RMPP - highlighter tool v6.rmn"
+    outputs = []
+    for jobs in (1, 2):
+        (tmp_path / str(jobs)).mkdir()
+        remarks.run_remarks(notebook, str(tmp_path / str(jobs)), renderer="native", jobs=jobs)
+        outputs.append(fitz.open(tmp_path / str(jobs) / "On computable numbers _remarks.pdf"))
+
+    sequential, parallel = outputs
+    assert parallel.page_count == sequential.page_count
+    for a, b in zip(sequential, parallel):
+        assert a.rect == b.rect
+        assert len(a.get_drawings()) == len(b.get_drawings())
+        assert [annot.rect for annot in a.annots()] == [annot.rect for annot in b.annots()]
+
+
+@pytest.mark.pdf
+def test_large_pages_are_exported_in_tiles(tmp_path):
+    pdf = fitz.open()
+    pdf.new_page(width=100, height=100)
+    pdf.new_page(width=720, height=360)
+    pdf.save(tmp_path / "in.pdf")
+
+    paths = PngExport(str(tmp_path / "in.pdf"), dpi=144, max_tile_size=500).save(str(tmp_path / "out"), [0, 1], jobs=2)
+
+    names = [pathlib.Path(path).name for path in paths]
+    # 1440 x 720 pixels in tiles of 500
+    assert names == ["page-001.png"] + [f"page-002-{row}-{column}.png" for row in (1, 2) for column in (1, 2, 3)]
+    tiles = [fitz.Pixmap(path) for path in paths[1:]]
+    assert sum(tile.width for tile in tiles[:3]) == 1440
+    assert sum(tile.height for tile in tiles[::3]) == 720
+    assert max(max(tile.width, tile.height) for tile in tiles) <= 500
+
+
+@pytest.mark.pdf
+def test_tiles_are_cut_from_one_display_list_per_page(tmp_path, monkeypatch):
+    pdf = fitz.open()
+    page = pdf.new_page(width=720, height=360)
+    for x in range(0, 720, 20):
+        page.draw_line((x, 0), (720 - x, 360), color=(x / 720, 0, 1), width=3)
+    pdf.save(tmp_path / "in.pdf")
+    display_lists = []
+    get_displaylist = fitz.Page.get_displaylist
+
+    def count_display_lists(*args, **kwargs):
+        display_lists.append(1)
+        return get_displaylist(*args, **kwargs)
+
+    monkeypatch.setattr(fitz.Page, "get_displaylist", count_display_lists)
+
+    paths = PngExport(str(tmp_path / "in.pdf"), dpi=144, max_tile_size=500).save(str(tmp_path / "out"), [0])
+
+    assert len(paths) == 6 and len(display_lists) == 1
+    monkeypatch.undo()
+    page = pdf[0]
+    for path, clip in zip(paths, [(0, 0, 250, 250), (250, 0, 500, 250), (500, 0, 720, 250)]):
+        assert fitz.Pixmap(path).samples == page.get_pixmap(dpi=144, clip=fitz.Rect(clip)).samples
+
+
+@pytest.mark.cache
+def test_rendered_overlays_are_cached(tmp_path, monkeypatch):
+    notebook = "tests/in/rmpp - v6 - black and white only.rmn"
+    configure_cache(tmp_path / "cache")
+    try:
+        (tmp_path / "first").mkdir()
+        remarks.run_remarks(notebook, str(tmp_path / "first"), renderer="native")
+
+        def render_pdf(parsed_page):
+            raise AssertionError("The overlay should have come from the cache")
+
+        monkeypatch.setattr(remarks.remarks, "render_pdf", render_pdf)
+        (tmp_path / "second").mkdir()
+        remarks.run_remarks(notebook, str(tmp_path / "second"), renderer="native")
+    finally:
+        configure_cache(None)
+
+    first, second = (fitz.open(next((tmp_path / run).glob("*.pdf"))) for run in ("first", "second"))
+    assert [len(page.get_drawings()) for page in first] == [len(page.get_drawings()) for page in second]
+
+
+@pytest.mark.pdf
+def test_identical_backgrounds_and_fonts_are_shared(tmp_path):
+    template = fitz.open()
+    for _ in range(3):
+        template.new_page(width=100, height=100).draw_line((0, 10), (100, 10))
+    template.save(tmp_path / "template.pdf")
+
+    pdf = RemarksPdf(fitz.open(tmp_path / "template.pdf"))
+    for page_idx in range(3):
+        overlay = fitz.open()
+        overlay.new_page(width=100, height=100).insert_text((10, 10), f"Page {page_idx}", fontname="helv")
+        page = pdf.new_page(page_idx, 100, 100)
+        page.show_pdf_page(page.rect, pdf.source, page_idx)
+        page.show_pdf_page(page.rect, overlay, 0)
+    pdf.save(str(tmp_path / "out"))
+
+    output = fitz.open(tmp_path / "out _remarks.pdf")
+    # The background is the first form shown on every page, the overlays differ
+    backgrounds = {xref for page in output for xref, name, *_ in page.get_xobjects() if name == "fzFrm0"}
+    assert len(backgrounds) == 1
+    assert len({xref for page in output for xref, *_ in page.get_fonts(full=True)}) == 1
+    assert [page.get_text().strip() for page in output] == ["Page 0", "Page 1", "Page 2"]
+
+
+@pytest.mark.pdf
+def test_incremental_saves_append_only_changed_pages(tmp_path):
+    source = fitz.open()
+    for _ in range(3):
+        source.new_page(width=100, height=100).draw_line((0, 10), (100, 10))
+    source.save(tmp_path / "source.pdf")
+
+    def output(changed_page=None):
+        pdf = RemarksPdf(fitz.open(tmp_path / "source.pdf"))
+        if changed_page is not None:
+            pdf.new_page(changed_page, 100, 100).insert_text((10, 10), "Changed", fontname="helv")
+        return pdf
+
+    written, _ = output().save(str(tmp_path / "out"), "incremental")
+    assert written == (tmp_path / "out _remarks.pdf").stat().st_size
+
+    assert output().save(str(tmp_path / "out"), "incremental")[0] == 0
+    assert 0 < output(1).save(str(tmp_path / "out"), "incremental")[0] < written
+    assert output(1).save(str(tmp_path / "out"), "incremental")[0] == 0
+
+    result = fitz.open(tmp_path / "out _remarks.pdf")
+    assert [page.get_text().strip() for page in result] == ["", "Changed", ""]
+
+
+@pytest.mark.pdf
+def test_heavy_pages_are_rasterized(tmp_path, caplog):
+    notebook = "tests/in/rmpp - v6 - black and white only.rmn"
+    caplog.set_level(logging.INFO)
+    for run, raster_threshold in (("vectors", None), ("raster", 100)):
+        (tmp_path / run).mkdir()
+        remarks.run_remarks(
+            notebook, str(tmp_path / run), renderer="native", raster_threshold=raster_threshold, raster_dpi=100
+        )
+
+    assert "drawing the annotations as an image at 100 dpi" in caplog.text
+    vectors, raster = (fitz.open(next((tmp_path / run).glob("*.pdf"))) for run in ("vectors", "raster"))
+    assert vectors[0].get_images() == [] and vectors[0].get_drawings() != []
+    (image,) = raster[0].get_images()
+    assert raster[0].get_drawings() == []
+    # 100 dpi over the width of the page
+    assert image[2] == pytest.approx(raster[0].rect.width * 100 / 72, abs=2)
+
+
+def misbehave(behavior):
+    if behavior == "hang":
+        time.sleep(60)
+    elif behavior == "crash":
+        os._exit(3)
+    elif behavior == "raise":
+        raise ValueError("broken page")
+    elif behavior == "allocate":
+        return len(bytearray(512 * 1024 * 1024))
+    return behavior
+
+
+@pytest.mark.pdf
+def test_watchdog_turns_failing_tasks_into_errors():
+    tasks = ["ok", "hang", "crash", "raise", "allocate", "fine"]
+    start = time.monotonic()
+
+    results = list(WatchdogPool(jobs=2, timeout=2, memory_limit=256 * 1024 * 1024).map(misbehave, tasks))
+
+    assert time.monotonic() - start < 30
+    assert results[0] == "ok" and results[-1] == "fine"
+    assert all(isinstance(result, RenderFailed) for result in results[1:-1])
+    assert "longer than 2 seconds" in str(results[1])
+    assert "exited with code 3" in str(results[2])
+    assert "broken page" in str(results[3])
+    assert "memory" in str(results[4])
+
+
+def worker_pid(pid_file=None):
+    if pid_file is not None:
+        pid_file.write_text(str(os.getpid()))
+    return os.getpid()
+
+
+@pytest.mark.pdf
+def test_watchdog_workers_are_kept_until_the_pool_is_closed(tmp_path):
+    pool = WatchdogPool(finalizer=functools.partial(worker_pid, tmp_path / "closed"))
+
+    (first,) = pool.map(worker_pid, [None])
+    (second,) = pool.map(worker_pid, [None])
+    pool.close()
+
+    assert first == second == int((tmp_path / "closed").read_text())
+
+
+def start_a_program_and_hang(pid_file):
+    program = subprocess.Popen(["sleep", "60"])
+    pid_file.write_text(str(program.pid))
+    time.sleep(60)
+
+
+def is_running(pid):
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            # Killed programs whose parent is gone may linger as zombies
+            return f.read().rsplit(")", 1)[1].split()[0] not in ("Z", "X")
+    except FileNotFoundError:
+        return False
+
+
+@pytest.mark.pdf
+@pytest.mark.skipif(not os.path.exists("/proc/self/stat"), reason="Needs /proc")
+def test_watchdog_kills_the_programs_a_worker_started(tmp_path):
+    (result,) = WatchdogPool(timeout=2).map(start_a_program_and_hang, [tmp_path / "pid"])
+
+    assert isinstance(result, RenderFailed)
+    pid = int((tmp_path / "pid").read_text())
+    deadline = time.monotonic() + 5
+    while is_running(pid) and time.monotonic() < deadline:
+        time.sleep(0.1)
+    assert not is_running(pid)
+
+
+def map_memory(size, preexec_fn=None):
+    program = [sys.executable, "-c", f"import mmap; mmap.mmap(-1, {size})"]
+    return subprocess.run(program, preexec_fn=preexec_fn, stderr=subprocess.DEVNULL).returncode
+
+
+@pytest.mark.pdf
+@pytest.mark.skipif(not MEMORY_LIMITS_SUPPORTED, reason="Memory limits are not supported")
+def test_memory_budgets_do_not_apply_to_inkscape():
+    pool = WatchdogPool(memory_limit=64 * 1024 * 1024)
+    size = 4 * 1024 * 1024 * 1024
+
+    assert list(pool.map(map_memory, [size, size], [None, INKSCAPE_PREEXEC])) == [1, 0]
+
+
+@pytest.mark.pdf
+def test_pages_over_their_budget_get_an_error(tmp_path, monkeypatch):
+    notebook = "tests/in/rmpp - v6 - various colors.rmn"
+    render_page = remarks.remarks.render_page
+
+    def hang_on_the_second_page(output_pdf, page_idx, *args):
+        if page_idx == 1:
+            time.sleep(60)
+        render_page(output_pdf, page_idx, *args)
+
+    # Inherited by the forked workers
+    monkeypatch.setattr(remarks.remarks, "render_page", hang_on_the_second_page)
+    remarks.run_remarks(notebook, str(tmp_path), renderer="native", page_timeout=5)
+
+    pdf = fitz.open(next(tmp_path.glob("*.pdf")))
+    errors = [[annot.info["content"] for annot in page.annots()] for page in pdf]
+    assert errors[1] == ["Scrybble error"]
+    assert all(page_errors == [] for page_idx, page_errors in enumerate(errors) if page_idx != 1)
+    assert pdf[0].get_drawings() != []